@@ -0,0 +1,81 @@
+import contextlib
+import hashlib
+import os
+import shutil
+
+from PIL import Image
+
+'''
+Content-addressed cache for the files the writers derive from icons and config.
+
+An asset is identified by its kind (the target format, e.g. a 39x39 RGBA icon or a
+categories.pc manifest) and the bytes it is made from (the source image or the
+serialized manifest entries). The SHA-256 of both is the cache key: the first build
+renders the asset into <directory>/<aa>/<key><extension> and every build, of either
+target, hard links it into place, or copies it where links are not possible.
+Repeated builds with unchanged icons and config therefore do no image or XML work.
+
+Entries are written to a temporary file and renamed, so both targets can share the
+cache while they are built concurrently.
+'''
+
+# Icons are scaled down to fit this size (we have not tested whether any other sizes/formats are supported)
+ICON_SIZE = 39
+
+
+def cache_key(kind, content):
+    digest = hashlib.sha256(kind.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(content)
+    return digest.hexdigest()
+
+
+class AssetCache(object):
+    ''' Renders assets into directory, or straight to their destination without one '''
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.rendered = 0
+
+    def path(self, key, extension):
+        return os.path.join(self.directory, key[:2], f'{key}{extension}')
+
+    def install(self, kind, content, render, dest):
+        ''' Put the asset kind made from content at dest, calling render(path) to make it
+            if it is not cached yet
+        '''
+        if self.directory is None:
+            render(dest)
+            self.rendered += 1
+            return
+        path = self.path(cache_key(kind, content), os.path.splitext(dest)[1])
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f'{path}.{os.getpid()}.tmp{os.path.splitext(dest)[1]}'
+            render(tmp)
+            os.replace(tmp, path)
+            self.rendered += 1
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(dest)
+        try:
+            os.link(path, dest)
+        except OSError:
+            shutil.copyfile(path, dest)
+
+    def icon(self, source, dest, rgba=False):
+        ''' Install source scaled down to ICON_SIZE, converted to RGBA if asked, as a png '''
+        def render(path):
+            img = Image.open(source)
+            if any(i > ICON_SIZE for i in img.size):
+                img.thumbnail((ICON_SIZE, ICON_SIZE), Image.LANCZOS)
+            if rgba:
+                img = img.convert('RGBA')
+            img.save(path, 'PNG')
+
+        with open(source, 'rb') as f:
+            self.install(f'icon{ICON_SIZE}{"-rgba" if rgba else ""}', f.read(), render, dest)
+
+    def image(self, source, dest):
+        ''' Install source re-encoded as a png '''
+        with open(source, 'rb') as f:
+            self.install('png', f.read(), lambda path: Image.open(source).save(path, 'PNG'), dest)
@@ -0,0 +1,351 @@
+import argparse
+import configparser
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy
+import pandas
+
+'''
+Offline benchmark of the build stages on synthetic data.
+
+    python benchmark.py [--sizes 10k,100k,1M] [--output benchmarks] [--compare FILE]
+
+For every size a synthetic Overpass union response with about that many elements is
+generated for the categories of config.ini, plus CSV and GPX sources of that many
+POIs, and every stage of the build is timed on its own:
+
+    json_parse      elements.parse of the response
+    tag_filter      the categories' row selection
+    merge_nearby    merging POIs closer than the categories' DedupeRadius
+    containment     the Europe point-in-polygon test
+    dedupe          dropping exact duplicate POIs
+    thin            the categories' MinSpacing and MaxPOIs thinning
+    poi_write       writing the per-category .poi bundles
+    gpx_write       exporting GPX like ExportGPX=True
+    read_geo_*      utils.read_geo of CSV, GPX and .poi sources
+    morton_encode   MIB2TSD Morton codes
+    mib2high_load   building (and with Optimize=True rewriting) the MIB2HIGH database
+    mib2tsd_load    building (and with Optimize=True rewriting) the MIB2TSD database
+    poifix          poifix.fix of both targets
+    zip             package.write_package of the output directory
+
+Results are written to <output>/<commit>.json, so runs of different commits can be
+compared with --compare. Nothing is downloaded.
+'''
+
+SIZES = {'10k': 10000, '100k': 100000, '1M': 1000000, '10M': 10000000}
+
+# The stages --skip can leave out, as no later stage needs their output
+OPTIONAL = ('gpx_write', 'read_geo_csv', 'read_geo_gpx')
+
+# Share of the elements per category, roughly as in the real data
+SHARES = {'speed_bumps': .35, 'rail_crossings': .25, 'fuel_stations': .15, 'speed_cameras': .1, 'fast_food': .1, 'average_speed': .05}
+
+BRANDS = ['Shell', 'BP', 'Orlen', 'Circle K', 'Lukoil', 'Aral', 'Total', 'Esso', 'OMV', 'MOL']
+FAST_FOOD = ["McDonald's", "Burger King", "Subway", "KFC", "Max Premium Burgers", "Kebab House", "Pizza Hut", "Local"]
+
+# Europe's bounding box plus a margin, so the containment test rejects part of the points
+BOUNDS = (-25.0, 34.0, 45.0, 72.0)
+
+
+def synthetic_points(rnd, n, duplicates=.03):
+    ''' Random coordinates with 7 decimals like Overpass, some of them repeated '''
+    lon = numpy.round(rnd.uniform(BOUNDS[0], BOUNDS[2], n), 7)
+    lat = numpy.round(rnd.uniform(BOUNDS[1], BOUNDS[3], n), 7)
+    repeat = numpy.flatnonzero(rnd.random(n) < duplicates)
+    repeat = repeat[repeat > 0]
+    lon[repeat] = lon[repeat - 1]
+    lat[repeat] = lat[repeat - 1]
+    return lon, lat
+
+
+def synthetic_element(name, rnd, id_, lon, lat):
+    ''' One element as the category's Overpass statement outputs it '''
+    way = rnd.random() < .15
+    center = {'lat': lat, 'lon': lon}
+    if name == 'average_speed':
+        if not way:
+            return {'type': 'node', 'id': id_, 'lat': lat, 'lon': lon, 'tags': {'enforcement': 'average_speed', 'maxspeed': '80'}}
+        return {'type': 'relation', 'id': id_, 'bounds': {'minlat': lat, 'minlon': lon, 'maxlat': lat + .02, 'maxlon': lon + .02},
+                'members': [{'type': 'node', 'ref': id_ * 2, 'role': 'from', 'lat': lat, 'lon': lon},
+                            {'type': 'node', 'ref': id_ * 2 + 1, 'role': 'to', 'lat': lat + .02, 'lon': lon + .02},
+                            {'type': 'way', 'ref': id_, 'role': 'section', 'geometry': [center, {'lat': lat + .02, 'lon': lon + .02}]}],
+                'tags': {'type': 'enforcement', 'enforcement': 'average_speed'}}
+    if name in ('fuel_stations', 'fast_food'):
+        tags = {'amenity': 'fuel' if name == 'fuel_stations' else 'fast_food', '_osm_type': 'way' if way else 'node'}
+        if name == 'fast_food':
+            tags['brand'] = FAST_FOOD[rnd.integers(len(FAST_FOOD))]
+        elif rnd.random() < .02:
+            tags['name'] = f'node/{id_}'
+        elif rnd.random() < .6:
+            tags['brand'] = tags['name'] = BRANDS[rnd.integers(len(BRANDS))]
+        elif rnd.random() < .8:
+            tags['name'] = f'Station {id_ % 5000}'
+        if way:
+            return {'type': 'item', 'id': id_, 'center': center, 'tags': tags}
+        return {'type': 'item', 'id': id_, 'geometry': {'type': 'Point', 'coordinates': [lon, lat]}, 'tags': tags}
+    tags = {'speed_bumps': {'traffic_calming': 'bump'}, 'rail_crossings': {'railway': 'level_crossing'},
+            'speed_cameras': {'highway': 'speed_camera'}}.get(name, {})
+    if way:
+        return {'type': 'way', 'id': id_, 'center': center, 'tags': tags}
+    return {'type': 'node', 'id': id_, 'lat': lat, 'lon': lon, 'tags': tags}
+
+
+def write_response(path, n, names, seed=0):
+    ''' Write a union Overpass response with about n elements over the categories names '''
+    rnd = numpy.random.default_rng(seed)
+    shares = {name: SHARES.get(name, 1 / len(names)) for name in names}
+    total = sum(shares.values())
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"version":0.6,"generator":"benchmark","osm3s":{"timestamp_osm_base":"2026-01-01T00:00:00Z",'
+                '"copyright":"synthetic"},"elements":[\n')
+        first_id = 1
+        for i, name in enumerate(names):
+            count = int(n * shares[name] / total)
+            f.write(('' if i == 0 else ',\n') + json.dumps({'type': 'category', 'id': i + 1, 'tags': {'name': name}}))
+            for start in range(0, count, 100000):
+                size = min(100000, count - start)
+                (lon, lat) = synthetic_points(rnd, size)
+                f.write(''.join(',\n' + json.dumps(synthetic_element(name, rnd, first_id + j, x, y))
+                                for j, (x, y) in enumerate(zip(lon.tolist(), lat.tolist()))))
+                first_id += size
+        f.write('\n]}\n')
+
+
+def write_sources(directory, n, seed=0):
+    ''' Write CSV and GPX sources of n POIs. Returns their paths. '''
+    rnd = numpy.random.default_rng(seed)
+    (lon, lat) = synthetic_points(rnd, n)
+    names = numpy.array(BRANDS + FAST_FOOD, dtype=object)[rnd.integers(len(BRANDS) + len(FAST_FOOD), size=n)]
+    csv = os.path.join(directory, 'source.csv')
+    pandas.DataFrame({'longitude': lon, 'latitude': lat, 'name': names}).to_csv(csv, index=False)
+    gpx = os.path.join(directory, 'source.gpx')
+    with open(gpx, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<gpx version="1.1" creator="benchmark" xmlns="http://www.topografix.com/GPX/1/1">\n')
+        for start in range(0, n, 100000):
+            f.write(''.join(f'<wpt lat="{y}" lon="{x}"><name>{name.replace("&", "&amp;")}</name></wpt>\n'
+                            for x, y, name in zip(lon[start:start + 100000].tolist(), lat[start:start + 100000].tolist(), names[start:start + 100000])))
+        f.write('</gpx>\n')
+    return csv, gpx
+
+
+class Timer(object):
+    def __init__(self, skip=()):
+        self.timings = {}
+        self.skip = set(skip)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        yield
+        self.timings[name] = time.perf_counter() - start
+
+    def wanted(self, name):
+        return not any(name == skip or name.startswith(skip + '_') for skip in self.skip)
+
+
+def run(n, config_file, tmp, timer, seed=0):
+    import mypois
+    import package
+    import poifix
+    import utils
+    from categories import read_categories
+    from elements import Elements, parse
+    from mib2high import MIB2HIGH
+    from mib2tsd import MIB2TSD
+    from morton import encode_morton_codes
+    from regions import read_regions
+
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read(config_file)
+    categories = read_categories(config)
+    # The writers' asset cache starts cold in every run, and the repository's cache stays untouched
+    config['General']['CacheDirectory'] = os.path.join(tmp, 'cache')
+    config_file = os.path.join(tmp, 'config.ini')
+    with open(config_file, 'w') as f:
+        config.write(f)
+
+    response = os.path.join(tmp, 'response.json')
+    write_response(response, n, [category.name for category in categories], seed)
+
+    stores = {category.name: Elements(category.tags) for category in categories}
+    with timer.stage('json_parse'), open(response, 'rb') as f:
+        parse(f, stores)
+    os.remove(response)
+
+    with timer.stage('tag_filter'):
+        selected = {category.name: category.select(stores[category.name]) for category in categories}
+    selected = {name: result for name, result in selected.items() if result is not None}
+    del stores
+
+    with timer.stage('merge_nearby'):
+        selected = {category.name: category.dedupe(*selected[category.name]) for category in categories if category.name in selected}
+
+    europe = read_regions(['Europe'])[0]
+    with timer.stage('containment'):
+        masks = {name: europe.contains(lon, lat) for name, (lon, lat, *_) in selected.items()}
+
+    with timer.stage('dedupe'):
+        pois = {name: pandas.DataFrame({'lon': lon[masks[name]], 'lat': lat[masks[name]], 'name': names[masks[name]],
+                                        'score': score[masks[name]]}).drop_duplicates(subset=['lon', 'lat', 'name'])
+                for name, (lon, lat, names, score) in selected.items()}
+    del selected, masks
+
+    with timer.stage('thin'):
+        for category in categories:
+            if category.name in pois:
+                poi = pois[category.name]
+                (keep, _) = category.thin(poi['lon'].to_numpy(), poi['lat'].to_numpy(), poi['score'].to_numpy())
+                pois[category.name] = poi[keep]
+
+    sources = {}
+    with timer.stage('poi_write'):
+        for name, poi in pois.items():
+            sources[name] = os.path.join(tmp, f'{name}.poi')
+            utils.write_geo_poi(sources[name], poi['lon'], poi['lat'], poi['name'])
+
+    if timer.wanted('gpx_write'):
+        import geopandas as gpd
+        with timer.stage('gpx_write'):
+            for name, poi in pois.items():
+                gpx = gpd.GeoDataFrame({'name': poi['name']}, geometry=gpd.points_from_xy(poi['lon'], poi['lat']), crs='epsg:4326')
+                gpx.to_file(os.path.join(tmp, f'{name}.gpx'), 'GPX', engine='fiona')
+
+    if any(timer.wanted(stage) for stage in ('read_geo_csv', 'read_geo_gpx')):
+        (csv, gpx) = write_sources(tmp, n, seed)
+        for (stage, source) in (('read_geo_csv', csv), ('read_geo_gpx', gpx)):
+            if timer.wanted(stage):
+                with timer.stage(stage), contextlib.redirect_stdout(None):
+                    utils.read_geo(source)
+    with timer.stage('read_geo_poi'):
+        for source in sources.values():
+            df = utils.read_geo(source)
+            df['lon'].to_numpy(), df['name'].to_numpy()
+
+    lon = numpy.concatenate([poi['lon'].to_numpy() for poi in pois.values()])
+    lat = numpy.concatenate([poi['lat'].to_numpy() for poi in pois.values()])
+    del pois
+    with timer.stage('morton_encode'):
+        encode_morton_codes(lat, lon)
+
+    output = os.path.join(tmp, 'output')
+    shutil.copytree(mypois.resource_path('template'), output)
+    targets = [(MIB2HIGH, os.path.join(output, 'PersonalPOI', 'MIB2', 'MIB2HIGH'), 'mib2high_load'),
+               (MIB2TSD, os.path.join(output, 'PersonalPOI', 'MIB2TSD'), 'mib2tsd_load')]
+    sections = {category.name: sources[category.name] for category in categories if category.name in sources}
+    for (target, dest, stage) in targets:
+        with timer.stage(stage), contextlib.redirect_stdout(None):
+            mypois.build(target, dest, config_file, sections, fix=False)
+
+    with timer.stage('poifix'):
+        for (_, dest, _) in targets:
+            poifix.fix(dest)
+
+    with timer.stage('zip'):
+        package.write_package(output, os.path.join(tmp, 'OSM_POI_Europe.zip'))
+
+
+def commit():
+    try:
+        sha = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+    return sha, dirty
+
+
+def peak_memory():
+    ''' Peak resident set size of this process in MiB, if the platform reports it '''
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 ** 2 if sys.platform == 'darwin' else 1024), 1)
+
+
+def compare(results, baseline, threshold):
+    ''' Print the ratio of every stage to the baseline. Returns True if a stage regressed. '''
+    regressed = False
+    for size, timings in results['results'].items():
+        for stage, seconds in timings.items():
+            before = baseline['results'].get(size, {}).get(stage)
+            if not before or stage == 'peak_memory_mib':
+                continue
+            ratio = seconds / before
+            flag = ' REGRESSION' if ratio > threshold else ''
+            regressed |= bool(flag)
+            print(f'{size:>9} {stage:<15} {before:9.3f}s -> {seconds:9.3f}s  x{ratio:.2f}{flag}')
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the build stages on synthetic data, offline')
+    parser.add_argument('--sizes', default='10k,100k,1M', help=f'comma separated sizes out of {",".join(SIZES)} (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=1, help='run every size this many times and keep the fastest timings')
+    parser.add_argument('--skip', default='', help=f'comma separated stages to skip out of {",".join(OPTIONAL)}, or read_geo for both sources')
+    parser.add_argument('--config', default='config.ini', help='categories and writer settings (default: %(default)s)')
+    parser.add_argument('--output', default='benchmarks', help='directory for the results (default: %(default)s)')
+    parser.add_argument('--compare', metavar='FILE', help='results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25, help='slowdown ratio reported as a regression (default: %(default)s)')
+    args = parser.parse_args()
+    skip = [stage.strip() for stage in args.skip.split(',') if stage.strip()]
+    unknown = [stage for stage in skip if not any(name == stage or name.startswith(stage + '_') for name in OPTIONAL)]
+    if unknown:
+        parser.error(f'cannot skip {",".join(unknown)}, only {",".join(OPTIONAL)}')
+
+    output = os.path.abspath(args.output)
+    config_file = os.path.abspath(args.config)
+    baseline = os.path.abspath(args.compare) if args.compare else None
+    # The writers read icons relative to the repository
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    (sha, dirty) = commit()
+    results = {
+        'commit': sha,
+        'dirty': dirty,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'results': {},
+    }
+    for size in args.sizes.split(','):
+        n = SIZES[size.strip()] if size.strip() in SIZES else int(size)
+        best = {}
+        for _ in range(args.repeat):
+            timer = Timer(skip)
+            with tempfile.TemporaryDirectory() as tmp:
+                run(n, config_file, tmp, timer)
+            for stage, seconds in timer.timings.items():
+                best[stage] = min(seconds, best.get(stage, seconds))
+        best = {stage: round(seconds, 4) for stage, seconds in best.items()}
+        best['peak_memory_mib'] = peak_memory()
+        results['results'][str(n)] = best
+        print(f'{n}: ' + ', '.join(f'{stage} {seconds}' for stage, seconds in best.items()))
+
+    os.makedirs(output, exist_ok=True)
+    path = os.path.join(output, f'{sha}{"-dirty" if dirty else ""}.json')
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {path}')
+
+    if baseline:
+        with open(baseline) as f:
+            if compare(results, json.load(f), args.threshold):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,57 @@
+import contextlib
+import sqlite3
+
+'''
+Build-time SQLite connection profile and bulk insert helpers for the poidata writers.
+
+While a database is being built nothing else reads it and a failed build is simply
+rerun, so the rollback journal and fsyncs are switched off and the connection keeps
+an exclusive lock and a large page cache. close() restores the default journal mode
+and locking so the shipped file is a plain rollback-journal database that the
+old SQLite versions on the head units can open.
+'''
+
+BUILD_PRAGMAS = {
+    'journal_mode': 'OFF',
+    'synchronous': 'OFF',
+    'locking_mode': 'EXCLUSIVE',
+    'cache_size': '-262144',  # 256 MiB
+    'temp_store': 'MEMORY',
+}
+
+RESTORE_PRAGMAS = {
+    'journal_mode': 'DELETE',
+    'synchronous': 'FULL',
+    'locking_mode': 'NORMAL',
+}
+
+
+def connect(db):
+    conn = sqlite3.connect(db, isolation_level=None)
+    for pragma, value in BUILD_PRAGMAS.items():
+        conn.execute(f'pragma {pragma}={value}')
+    return conn
+
+
+@contextlib.contextmanager
+def transaction(conn):
+    conn.execute('begin')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('rollback')
+        raise
+    conn.execute('commit')
+
+
+def insert(conn, table, columns, rows):
+    ''' Insert an iterable of row tuples into table with a single executemany '''
+    conn.executemany(f'insert into "{table}" ({",".join(columns)}) values ({",".join("?" * len(columns))})', rows)
+
+
+def close(conn):
+    for pragma, value in RESTORE_PRAGMAS.items():
+        conn.execute(f'pragma {pragma}={value}')
+    # Leaving exclusive locking mode only takes effect on the next access
+    conn.execute('select count(*) from sqlite_master').fetchone()
+    conn.close()
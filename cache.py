@@ -0,0 +1,137 @@
+import contextlib
+import gzip
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+'''
+On-disk cache for Overpass responses.
+
+Entries are keyed by the SHA-256 of the endpoint plus the normalized query text and
+stored gzip-compressed under <directory>/objects/<aa>/<key>.json.gz. A small sqlite
+index keeps the size, expiry and last access time of every entry so that expired
+entries can be dropped and the least recently used ones evicted once the cache grows
+beyond its size limit.
+'''
+
+
+class CacheMiss(Exception):
+    pass
+
+
+def normalize(url):
+    ''' Reduce a query URL to a canonical form so that insignificant whitespace
+        differences do not produce different cache keys.
+    '''
+    parts = urlsplit(url)
+    query = parse_qs(parts.query).get('data', [parts.query])[0]
+    query = re.sub(r'\s*([;()\[\]{},])\s*', r'\1', ' '.join(query.split()))
+    return f'{parts.netloc}{parts.path}?{query}'
+
+
+def cache_key(url):
+    return hashlib.sha256(normalize(url).encode('utf-8')).hexdigest()
+
+
+class ResponseCache(object):
+    def __init__(self, directory, ttl=6 * 24 * 3600, max_size=4 * 1024 ** 3, offline=False):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+        os.makedirs(os.path.join(directory, 'objects'), exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(directory, 'index.db'), timeout=60, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute('create table if not exists "entries" (key TEXT PRIMARY KEY,url TEXT,size INTEGER,created REAL,expires REAL,accessed REAL)')
+
+    def path(self, key):
+        return os.path.join(self.directory, 'objects', key[:2], f'{key}.json.gz')
+
+    def open(self, url):
+        ''' Return a binary file object with the cached payload for url, or None.
+            In offline mode expired entries are still served.
+        '''
+        key = cache_key(url)
+        with self.lock:
+            row = self.conn.execute('select expires from entries where key=?', (key,)).fetchone()
+            if row is None or (row[0] < time.time() and not self.offline):
+                return None
+            try:
+                f = gzip.open(self.path(key), 'rb')
+            except FileNotFoundError:
+                self.conn.execute('delete from entries where key=?', (key,))
+                return None
+            self.conn.execute('update entries set accessed=? where key=?', (time.time(), key))
+            return f
+
+    def get(self, url):
+        f = self.open(url)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def put(self, url, payload, ttl=None):
+        self.put_stream(url, [payload], ttl).close()
+
+    def put_stream(self, url, chunks, ttl=None):
+        ''' Store the payload and return it opened for reading. The new entry is kept
+            until the next one is stored, even if it does not fit max_size.
+        '''
+        key = cache_key(url)
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp, 'wb') as raw, gzip.GzipFile(filename='', mode='wb', compresslevel=6, fileobj=raw, mtime=0) as f:
+                for chunk in chunks:
+                    f.write(chunk)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp)
+            raise
+        os.replace(tmp, path)
+
+        now = time.time()
+        with self.lock:
+            f = gzip.open(path, 'rb')
+            self.conn.execute('insert or replace into entries values(?,?,?,?,?,?)',
+                              (key, url, os.path.getsize(path), now, now + (self.ttl if ttl is None else ttl), now))
+            self.evict(keep=key)
+        return f
+
+    def discard(self, url):
+        key = cache_key(url)
+        with self.lock:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path(key))
+            self.conn.execute('delete from entries where key=?', (key,))
+
+    def evict(self, keep=None):
+        ''' Drop expired entries, then the least recently used ones until the cache fits max_size,
+            except the entry keep. Callers must hold self.lock.
+        '''
+        now = time.time()
+        expired = [key for (key,) in self.conn.execute('select key from entries where expires<?', (now,)) if key != keep]
+        (total,) = self.conn.execute('select coalesce(sum(size),0) from entries where expires>=?', (now,)).fetchone()
+        victims = expired
+        if total > self.max_size:
+            for key, size in self.conn.execute('select key,size from entries where expires>=? order by accessed', (now,)):
+                if total <= self.max_size:
+                    break
+                if key == keep:
+                    continue
+                victims.append(key)
+                total -= size
+
+        for key in victims:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path(key))
+            self.conn.execute('delete from entries where key=?', (key,))
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,168 @@
+import re
+
+import numpy
+
+import spatial
+
+'''
+POI categories declared in config.ini.
+
+Every section other than [General] is a category. Besides the options mypois.py
+reads, a section describes what to fetch and which rows to keep:
+
+    Selector  Overpass selector, e.g. nwr["amenity"="fuel"]
+    Output    Overpass output statements, default "out center"
+    Types     element types to keep, e.g. node (default: all)
+    Roles     relation member roles whose positions are kept (default: none)
+    Filter    one tag condition per line, see Condition
+    NameTags  tags to name a POI by, the first one present wins
+    Label     fixed name for every POI, instead of NameTags
+    DedupeRadius  POIs closer than this many metres are merged into one (default: 0, off)
+    DedupeWinner  which POI of a merged group is kept, see WINNERS (default: the first)
+    MinSpacing    POIs are thinned to at least this many metres apart (default: 0, off)
+    MaxPOIs       at most this many POIs are kept, thinning the densest cells first (default: 0, no cap)
+    ThinCell      cell size in metres of the MaxPOIs grid (default: 10000)
+
+A category compiles these into masks over the columnar Elements of a fetch: tag
+conditions are evaluated once per distinct value and mapped to the rows with NumPy.
+Near-duplicates are merged right after selection, thinning applies to the POIs left
+within the region, dropping those DedupeWinner ranks lowest first.
+'''
+
+
+# Rules for the POI kept when near-duplicates are merged, listed in order of importance
+WINNERS = {
+    'named': 'POIs with a name',
+    'node': 'nodes, e.g. over the center of a way mapping the same thing',
+    'way': 'way centers',
+    'relation': 'relation centers',
+    'member': 'relation members, e.g. the from/to devices of an average speed section',
+}
+
+
+def split(value):
+    return [item.strip() for item in (value or '').split(',') if item.strip()]
+
+
+class Condition(object):
+    ''' One Filter line:
+
+        key          the tag is present
+        !key         the tag is absent
+        key=a|b      the tag is one of the values
+        key!=a|b     the tag is absent or none of the values
+        key~text     the tag contains text
+        key!~text    the tag is absent or does not contain text
+    '''
+
+    def __init__(self, line):
+        match = re.fullmatch(r'(!?)([^!=~]+?)\s*(?:(!=|!~|=|~)\s*(.*))?', line.strip())
+        if match is None or (match.group(1) and match.group(3)):
+            raise ValueError(f'Invalid filter condition: {line}')
+        (absent, self.key, self.operator, operand) = match.groups()
+        self.operator = self.operator or ('!' if absent else '')
+        self.values = set(operand.split('|')) if self.operator in ('=', '!=') else operand
+
+    def matches(self, value):
+        if self.operator == '':
+            return value is not None
+        if self.operator == '!':
+            return value is None
+        if self.operator == '=':
+            return value in self.values
+        if self.operator == '!=':
+            return value not in self.values
+        if self.operator == '~':
+            return value is not None and self.values in value
+        return value is None or self.values not in value
+
+
+class Category(object):
+    def __init__(self, name, section):
+        self.name = name
+        self.statement = f'{section["Selector"]}(area.searchArea);{section.get("Output", "out center")};'
+        self.types = split(section.get('Types'))
+        self.roles = split(section.get('Roles'))
+        self.conditions = [Condition(line) for line in section.get('Filter', '').splitlines() if line.strip()]
+        self.name_tags = split(section.get('NameTags'))
+        self.label = section.get('Label')
+        if not self.label and not self.name_tags:
+            raise ValueError(f'Category {name} needs a Label or NameTags')
+        self.radius = float(section.get('DedupeRadius', 0))
+        self.winner = split(section.get('DedupeWinner'))
+        self.spacing = float(section.get('MinSpacing', 0))
+        self.limit = int(section.get('MaxPOIs', 0))
+        self.cell = float(section.get('ThinCell', 10000))
+        for rule in self.winner:
+            if rule not in WINNERS:
+                raise ValueError(f'Category {name}: unknown DedupeWinner {rule}, expected one of {", ".join(WINNERS)}')
+
+        # Tags kept from the Overpass response
+        self.tags = list(dict.fromkeys([condition.key for condition in self.conditions] + self.name_tags))
+
+    def __call__(self, data):
+        ''' Select the POIs of a fetch and merge near-duplicates. Returns (lon, lat, names, score)
+            or None if there is no data.
+        '''
+        result = self.select(data)
+        return None if result is None else self.dedupe(*result)
+
+    def select(self, data):
+        ''' The POIs of a fetch as (lon, lat, names, score), score ranking them by
+            DedupeWinner, or None if there is no data.
+        '''
+        if not len(data):
+            return None
+        lon, lat = data.coordinates()
+        mask = ~(numpy.isnan(lon) | numpy.isnan(lat))
+        if self.types:
+            mask &= data.is_type(*self.types)
+        mask &= (data.is_member(*self.roles) | ~data.is_member()) if self.roles else ~data.is_member()
+        for condition in self.conditions:
+            mask &= data.tags[condition.key].mask(condition.matches)
+
+        if self.label:
+            names = numpy.full(mask.sum(), self.label)
+        else:
+            names = data.tags[self.name_tags[-1]].array()[mask]
+            for tag in reversed(self.name_tags[:-1]):
+                column = data.tags[tag]
+                names = numpy.where(column.mask(lambda value: value is not None)[mask], column.array()[mask], names)
+
+        # Each rule is worth more than all the rules after it together
+        score = numpy.zeros(mask.sum(), dtype=numpy.int64)
+        for rule in self.winner:
+            if rule == 'named':
+                preferred = numpy.array([bool(name) for name in names.tolist()], dtype=bool)
+            elif rule == 'member':
+                preferred = data.is_member()[mask]
+            else:
+                preferred = data.is_type(rule)[mask]
+            score = score * 2 + preferred
+        return lon[mask], lat[mask], names, score
+
+    def dedupe(self, lon, lat, names, score):
+        ''' Merge the POIs closer than DedupeRadius into the best one '''
+        if self.radius <= 0:
+            return lon, lat, names, score
+        keep = spatial.dedupe(lon, lat, self.radius, score)
+        return lon[keep], lat[keep], names[keep], score[keep]
+
+    def thin(self, lon, lat, score):
+        ''' Mask of the POIs kept by MinSpacing and MaxPOIs, and the number each of them removed '''
+        keep = numpy.ones(len(lon), dtype=bool)
+        removed = {}
+        if self.spacing > 0:
+            keep = spatial.dedupe(lon, lat, self.spacing, score)
+            removed['MinSpacing'] = int((~keep).sum())
+        if self.limit and keep.sum() > self.limit:
+            kept = numpy.flatnonzero(keep)
+            keep[kept[~spatial.thin(lon[kept], lat[kept], self.limit, self.cell, score[kept])]] = False
+            removed['MaxPOIs'] = len(kept) - self.limit
+        return keep, removed
+
+
+def read_categories(config):
+    ''' The enabled categories of a config.ini '''
+    return [Category(section, config[section]) for section in config.sections()
+            if section != 'General' and not config.getboolean(section, 'Disabled', fallback=False)]
@@ -0,0 +1,58 @@
+import contextlib
+import hashlib
+import json
+import os
+import time
+import zipfile
+
+from elements import Elements
+
+'''
+Per-category datasets of the previous run, so later runs only fetch what changed.
+
+Each dataset is the category's Elements saved under <directory>/<name>.npz together
+with the Overpass timestamp the data is valid for, the time it was last fetched in
+full and a fingerprint of the query that produced it. A dataset is only reused while
+its fingerprint matches and its last full fetch is younger than the refresh interval:
+newer: selects elements by their own timestamp, so a way or relation whose nodes moved
+without the element itself changing is only picked up by the next full fetch.
+'''
+
+
+def fingerprint(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class DatasetStore(object):
+    def __init__(self, directory, refresh=28 * 24 * 3600):
+        self.directory = directory
+        self.refresh = refresh
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.directory, f'{name}.npz')
+
+    def load(self, name, fingerprint):
+        ''' Return (elements, full) of a reusable dataset, full being the time of its
+            last full fetch, or None if the category has to be fetched in full.
+        '''
+        try:
+            (elements, meta) = Elements.load(self.path(name))
+        except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile):
+            # A missing or corrupt dataset is fetched in full again
+            return None
+        if meta.get('fingerprint') != fingerprint or elements.timestamp is None or time.time() - meta.get('full', 0) > self.refresh:
+            return None
+        return elements, meta['full']
+
+    def save(self, name, fingerprint, elements, full):
+        path = self.path(name)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                elements.save(f, fingerprint=fingerprint, full=full)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp)
+            raise
+        os.replace(tmp, path)
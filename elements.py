@@ -0,0 +1,286 @@
+import codecs
+import json
+import math
+import re
+from array import array
+
+import numpy
+
+'''
+Columnar storage for Overpass elements and a streaming parser for Overpass JSON.
+
+The parser decodes the "elements" array one element at a time and keeps only the
+fields the categories need: type, id, a coordinate (node position, way/relation
+center or converted item geometry), the member role for relation members and a
+selected set of tags. Coordinates and ids go into typed arrays, strings are
+dictionary-encoded, so memory grows with the output rather than the raw JSON.
+
+Relation members that carry a position (out geom) are stored as rows of their own
+with their role set and follow the row of their relation; all other rows have role None.
+Converted items (convert item ...,_osm_type=type()) keep the OSM type of their source.
+'''
+
+# Rows are identified by id * 4 + the index of their OSM type
+TYPES = {'node': 0, 'way': 1, 'relation': 2}
+
+
+class IncompleteResponse(Exception):
+    ''' The response ends with a runtime error remark, e.g. the query timed out or ran
+        out of memory, so its elements are incomplete.
+    '''
+    pass
+
+
+class Strings(object):
+    ''' Dictionary-encoded string column. Code 0 is None. '''
+
+    def __init__(self):
+        self.codes = array('i')
+        self.values = [None]
+        self.index = {None: 0}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def code(self, value):
+        code = self.index.get(value)
+        if code is None:
+            code = self.index[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def append(self, value):
+        self.codes.append(self.code(value))
+
+    def extend(self, other):
+        remap = numpy.array([self.code(value) for value in other.values], dtype=numpy.int32)
+        self.codes.frombytes(remap[other.array_codes()].tobytes())
+
+    def array_codes(self):
+        return numpy.frombuffer(self.codes, dtype=numpy.int32)
+
+    def mask(self, predicate):
+        ''' Evaluate predicate once per distinct value and return a row mask '''
+        return numpy.array([predicate(value) for value in self.values], dtype=bool)[self.array_codes()]
+
+    def array(self):
+        return numpy.array(self.values, dtype=object)[self.array_codes()]
+
+    def select(self, mask):
+        other = Strings()
+        other.values = list(self.values)
+        other.index = dict(self.index)
+        other.codes.frombytes(self.array_codes()[mask].tobytes())
+        return other
+
+    def save(self, arrays, prefix):
+        arrays[f'{prefix}.values'] = numpy.array(self.values[1:], dtype=str)
+        arrays[f'{prefix}.codes'] = self.array_codes()
+
+    @classmethod
+    def load(cls, arrays, prefix):
+        strings = cls()
+        for value in arrays[f'{prefix}.values'].tolist():
+            strings.code(value)
+        strings.codes.frombytes(arrays[f'{prefix}.codes'].astype(numpy.int32).tobytes())
+        return strings
+
+
+class Elements(object):
+    def __init__(self, tags=()):
+        self.type = Strings()
+        self.role = Strings()
+        self.id = array('q')
+        self.lon = array('d')
+        self.lat = array('d')
+        self.tags = {key: Strings() for key in tags}
+        # osm3s.timestamp_osm_base of the response the rows came from, if known
+        self.timestamp = None
+
+    def __len__(self):
+        return len(self.id)
+
+    def append(self, type_, id_, lon, lat, tags, role=None):
+        self.type.append(type_)
+        self.role.append(role)
+        self.id.append(id_)
+        self.lon.append(lon)
+        self.lat.append(lat)
+        for key, column in self.tags.items():
+            column.append(tags.get(key))
+
+    def add(self, element):
+        # geometry is GeoJSON for convert/geom(), but a list of points for a way under out geom
+        geometry = element.get('geometry')
+        if 'lon' in element:
+            lon, lat = element['lon'], element['lat']
+        elif 'center' in element:
+            lon, lat = element['center']['lon'], element['center']['lat']
+        elif isinstance(geometry, dict) and geometry.get('type') == 'Point':
+            lon, lat = geometry['coordinates']
+        elif 'bounds' in element:
+            bounds = element['bounds']
+            lon, lat = (bounds['minlon'] + bounds['maxlon']) / 2, (bounds['minlat'] + bounds['maxlat']) / 2
+        elif isinstance(geometry, list) and any(geometry):
+            point = next(point for point in geometry if point)
+            lon, lat = point['lon'], point['lat']
+        else:
+            lon, lat = math.nan, math.nan
+        tags = element.get('tags', {})
+        type_ = element['type'] if element['type'] in TYPES else tags.get('_osm_type', element['type'])
+        self.append(type_, element.get('id', 0), lon, lat, tags)
+
+        for member in element.get('members', ()):
+            if 'lon' in member:
+                self.append(member['type'], member['ref'], member['lon'], member['lat'], {}, member.get('role', ''))
+
+    def extend(self, other):
+        self.type.extend(other.type)
+        self.role.extend(other.role)
+        self.id.extend(other.id)
+        self.lon.extend(other.lon)
+        self.lat.extend(other.lat)
+        for key, column in self.tags.items():
+            column.extend(other.tags[key])
+
+    def coordinates(self):
+        return numpy.frombuffer(self.lon, dtype=numpy.float64), numpy.frombuffer(self.lat, dtype=numpy.float64)
+
+    def is_type(self, *types):
+        return self.type.mask(lambda value: value in types)
+
+    def is_member(self, *roles):
+        return self.role.mask(lambda value: value is not None and (not roles or value in roles))
+
+    def anchors(self):
+        ''' Position of the element each row belongs to: its own coordinate, or for a
+            relation without one the coordinate of its first positioned member.
+            NaN if the element has no position at all.
+        '''
+        lon, lat = self.coordinates()
+        top = self.role.array_codes() == 0
+        element = numpy.cumsum(top) - 1
+        positioned = numpy.flatnonzero(~(numpy.isnan(lon) | numpy.isnan(lat)))
+        (found, first) = numpy.unique(element[positioned], return_index=True)
+        anchor_lon = numpy.full(top.sum(), numpy.nan)
+        anchor_lat = numpy.full(top.sum(), numpy.nan)
+        anchor_lon[found] = lon[positioned[first]]
+        anchor_lat[found] = lat[positioned[first]]
+        return anchor_lon[element], anchor_lat[element]
+
+    def keys(self):
+        ''' Key (id * 4 + type index) of the element each row belongs to; relation
+            member rows get the key of their relation.
+        '''
+        types = numpy.array([TYPES.get(value, 3) for value in self.type.values], dtype=numpy.int64)
+        keys = numpy.frombuffer(self.id, dtype=numpy.int64) * 4 + types[self.type.array_codes()]
+        top = self.role.array_codes() == 0
+        return keys[top][numpy.cumsum(top) - 1]
+
+    def select(self, mask):
+        other = Elements()
+        other.type = self.type.select(mask)
+        other.role = self.role.select(mask)
+        other.id.frombytes(numpy.frombuffer(self.id, dtype=numpy.int64)[mask].tobytes())
+        lon, lat = self.coordinates()
+        other.lon.frombytes(lon[mask].tobytes())
+        other.lat.frombytes(lat[mask].tobytes())
+        other.tags = {key: column.select(mask) for key, column in self.tags.items()}
+        other.timestamp = self.timestamp
+        return other
+
+    def save(self, f, **meta):
+        arrays = {'id': numpy.frombuffer(self.id, dtype=numpy.int64)}
+        arrays['lon'], arrays['lat'] = self.coordinates()
+        self.type.save(arrays, 'type')
+        self.role.save(arrays, 'role')
+        for key, column in self.tags.items():
+            column.save(arrays, f'tags.{key}')
+        arrays['meta'] = numpy.array(json.dumps(dict(meta, tags=list(self.tags), timestamp=self.timestamp)))
+        numpy.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, f):
+        ''' Load Elements saved with save(). Returns (elements, meta). '''
+        with numpy.load(f, allow_pickle=False) as arrays:
+            meta = json.loads(arrays['meta'].item())
+            elements = cls()
+            elements.type = Strings.load(arrays, 'type')
+            elements.role = Strings.load(arrays, 'role')
+            elements.id.frombytes(arrays['id'].tobytes())
+            elements.lon.frombytes(arrays['lon'].tobytes())
+            elements.lat.frombytes(arrays['lat'].tobytes())
+            elements.tags = {key: Strings.load(arrays, f'tags.{key}') for key in meta['tags']}
+            elements.timestamp = meta['timestamp']
+        return elements, meta
+
+
+def merge(previous, listing, changes):
+    ''' Bring previous up to date: keep the rows of elements that are still listed and
+        did not change, then append changes. listing holds the keys of every element
+        that currently matches the query (out ids), changes the elements modified since.
+    '''
+    keys = previous.keys()
+    keep = numpy.isin(keys, listing.keys()) & ~numpy.isin(keys, changes.keys())
+    merged = previous.select(keep)
+    merged.extend(changes)
+    merged.timestamp = changes.timestamp
+    return merged
+
+
+def parse(f, stores, chunk_size=1 << 20):
+    ''' Stream the Overpass JSON response in binary file object f into stores, a dict
+        of category name to Elements. Each category's output must be preceded by a
+        "category" marker element naming it; elements before the first marker are dropped.
+        Raises IncompleteResponse if Overpass aborted the query.
+    '''
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    buf, pos, eof = '', 0, False
+    current = None
+
+    def more():
+        nonlocal buf, pos, eof
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buf = buf[pos:] + text.decode(chunk, final=eof)
+        pos = 0
+        return not eof
+
+    # Skip the header up to the start of the elements array
+    while (start := buf.find('"elements"')) < 0 or buf.find('[', start) < 0:
+        if not more():
+            raise ValueError('No elements array in Overpass response')
+    pos = buf.find('[', start) + 1
+
+    timestamp = re.search(r'"timestamp_osm_base"\s*:\s*"([^"]*)"', buf[:start])
+    for store in stores.values():
+        store.timestamp = timestamp and timestamp.group(1)
+
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos == len(buf):
+            if not more():
+                raise ValueError('Truncated Overpass response')
+            continue
+        if buf[pos] == ']':
+            # Overpass reports timeouts and memory exhaustion in a remark after the elements
+            while more():
+                pass
+            remark = re.search(r'"remark"\s*:\s*"((?:[^"\\]|\\.)*)"', buf[pos:])
+            if remark and 'runtime error' in remark.group(1):
+                raise IncompleteResponse(json.loads(f'"{remark.group(1)}"'))
+            return stores
+        try:
+            element, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if not more():
+                raise
+            continue
+        pos = end
+
+        if element.get('type') == 'category':
+            current = stores[element['tags']['name']]
+        elif current is not None:
+            current.add(element)
@@ -0,0 +1,100 @@
+import multiprocessing
+import threading
+import time
+
+'''
+Progress events of a build, pushed to the main process.
+
+Code anywhere in the build reports what it did with emit(kind, **fields), e.g. a
+finished request with its size or the POIs written for a category. In the main
+process an open Channel hands events straight to its sink. Worker processes started
+with worker_args() put them on a multiprocessing queue instead, which a listener
+thread of the main process blocks on; nothing polls. Without a Channel
+events are dropped, so the modules also work on their own.
+
+Stats turns the events into throughput figures for the rich display and the CI log.
+'''
+
+_sink = None
+_queue = None
+_channel = None
+_lock = threading.Lock()
+
+
+def emit(kind, **fields):
+    if _sink is not None:
+        with _lock:
+            _sink(kind, fields)
+    elif _queue is not None:
+        _queue.put((kind, fields))
+
+
+def init_worker(queue):
+    ''' ProcessPoolExecutor initializer: send the worker's events to queue '''
+    global _sink, _queue
+    # A forked worker inherits the sink of the main process
+    _sink = None
+    _queue = queue
+
+
+class Channel(object):
+    ''' Delivers the events of this process and its workers to sink(kind, fields),
+        one at a time, while open.
+    '''
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.queue = multiprocessing.Queue()
+        self.listener = threading.Thread(target=self.listen, name='events', daemon=True)
+
+    def listen(self):
+        while (event := self.queue.get()) is not None:
+            with _lock:
+                self.sink(*event)
+
+    def __enter__(self):
+        global _sink, _channel
+        (_sink, _channel) = (self.sink, self)
+        self.listener.start()
+        return self
+
+    def __exit__(self, *exc):
+        global _sink, _channel
+        self.queue.put(None)
+        self.listener.join()
+        (_sink, _channel) = (None, None)
+        return False
+
+
+def worker_args():
+    ''' Keyword arguments for a ProcessPoolExecutor whose workers should report to the
+        open Channel, if there is one
+    '''
+    return {'initializer': init_worker, 'initargs': (_channel.queue,)} if _channel is not None else {}
+
+
+class Stats(object):
+    ''' Counters of the request, retry and pois events with their rates since start '''
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.requests = 0
+        self.cached = 0
+        self.bytes = 0
+        self.retries = 0
+        self.pois = 0
+
+    def add(self, kind, fields):
+        if kind == 'request':
+            self.requests += 1
+            self.cached += fields.get('cached', False)
+            self.bytes += fields.get('bytes', 0)
+        elif kind == 'retry':
+            self.retries += 1
+        elif kind == 'pois':
+            self.pois += fields['count']
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        return (f'{(self.requests - self.cached) / elapsed:.2f} req/s, {self.bytes / elapsed / 2 ** 20:.2f} MiB/s, '
+                f'{self.pois / elapsed:.0f} POIs/s, {self.cached} cached, {self.retries} retries')
@@ -1,361 +1,302 @@
+import argparse
+import asyncio
+import atexit
 import configparser
 import contextlib
 import geopandas as gpd
-import glob
-import inspect
-import multiprocessing
 import os
-import requests
-import shutil
-from concurrent.futures import ProcessPoolExecutor
-from retrying import retry
+import pandas
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from rich import progress
-from shapely.geometry import Point, Polygon
 
+import events
 import mypois
+import overpass
+import package
+import pbf
+import tiles
+import tracing
+import utils
+from categories import read_categories
+from datasets import DatasetStore, fingerprint
+from elements import Elements, IncompleteResponse, merge
+from regions import coverage, read_regions
+
+
+def generate(lon, lat, names, score, category, region, export_gpx=False):
+    name = category.name
+    with tracing.span('containment', region=region.name, rows=len(lon)) as span:
+        mask = region.contains(lon, lat)
+        span.set(inside=int(mask.sum()))
+    with tracing.span('dedupe') as span:
+        poi = pandas.DataFrame({"lon": lon[mask], "lat": lat[mask], "name": names[mask], "score": score[mask]})
+        poi = poi.drop_duplicates(subset=["lon", "lat", "name"])
+        span.rows(len(poi))
+    with tracing.span('thin') as span:
+        (keep, removed) = category.thin(poi['lon'].to_numpy(), poi['lat'].to_numpy(), poi['score'].to_numpy())
+        if removed:
+            print(f'{name} ({region.name}): thinning kept {keep.sum()} of {len(poi)} POIs, removed '
+                  + ', '.join(f'{count} by {rule}' for rule, count in removed.items()))
+        poi = poi[keep]
+        span.set(**removed)
+        span.rows(len(poi))
+    os.makedirs(f'data/{region.name}', exist_ok=True)
+    with tracing.span('write_poi', rows=len(poi)):
+        utils.write_geo_poi(f'data/{region.name}/{name}.poi', poi['lon'], poi['lat'], poi['name'])
+    events.emit('pois', category=name, region=region.name, count=len(poi), thinned=sum(removed.values()))
 
-europe_lon_lat_list = [
-    ['-5.863332', '81.434750'],
-    ['-6.704456', '74.786230'],
-    ['-34.492960', '62.807440'],
-    ['-30.837530', '30.816590'],
-    ['-15.764107', '29.735139'],
-    ['-9.611205', '35.985870'],
-    ['-5.653329', '35.894580'],
-    ['-5.401044', '35.937190'],
-    ['-5.377002', '35.879620'],
-    ['-5.345073', '35.865680'],
-    ['-5.261097', '35.760390'],
-    ['-5.001727', '35.734240'],
-    ['-3.105293', '35.432621'],
-    ['-2.922474', '35.472141'],
-    ['-2.914235', '35.353502'],
-    ['-2.946335', '35.324656'],
-    ['-2.963845', '35.316812'],
-    ['-2.970368', '35.300843'],
-    ['-2.972428', '35.285430'],
-    ['-2.951485', '35.263288'],
-    ['-2.929856', '35.269174'],
-    ['-2.912861', '35.287112'],
-    ['-2.159529', '35.779803'],
-    ['3.541102', '37.759810'],
-    ['11.600370', '37.858610'],
-    ['11.595620', '35.538050'],
-    ['13.002900', '34.000000'],
-    ['33.271500', '33.997190'],
-    ['34.769750', '34.854310'],
-    ['35.266660', '35.625790'],
-    ['36.236940', '35.806410'],
-    ['36.768620', '36.195300'],
-    ['36.754060', '36.570560'],
-    ['39.642720', '36.647060'],
-    ['40.840170', '37.092560'],
-    ['41.288950', '37.026240'],
-    ['42.398570', '37.054530'],
-    ['43.272420', '37.242670'],
-    ['44.328630', '36.914900'],
-    ['44.996930', '37.199370'],
-    ['44.519020', '38.649450'],
-    ['44.183540', '39.276880'],
-    ['44.879710', '39.640220'],
-    ['44.507940', '40.075790'],
-    ['43.981600', '40.164760'],
-    ['43.759980', '41.039710'],
-    ['44.851450', '41.068950'],
-    ['44.997140', '41.265530'],
-    ['45.039480', '41.289400'],
-    ['45.136930', '41.349450'],
-    ['45.181900', '41.401940'],
-    ['45.256860', '41.431920'],
-    ['45.316820', '41.446910'],
-    ['45.371790', '41.415060'],
-    ['45.449240', '41.405690'],
-    ['45.609150', '41.341940'],
-    ['45.694100', '41.340070'],
-    ['45.684100', '41.291280'],
-    ['45.726580', '41.234930'],
-    ['45.883990', '41.178540'],
-    ['46.006420', '41.161610'],
-    ['46.111350', '41.161610'],
-    ['46.196300', '41.174780'],
-    ['46.288750', '41.167260'],
-    ['46.336220', '41.122100'],
-    ['46.376200', '41.080680'],
-    ['46.446160', '41.063730'],
-    ['46.493630', '41.046770'],
-    ['46.653540', '41.091980'],
-    ['46.678520', '41.163490'],
-    ['46.753480', '41.293150'],
-    ['46.636050', '41.400070'],
-    ['46.443660', '41.465630'],
-    ['46.346220', '41.538610'],
-    ['46.358710', '41.596560'],
-    ['46.286250', '41.637650'],
-    ['46.241280', '41.652590'],
-    ['46.218790', '41.704840'],
-    ['46.258770', '41.745870'],
-    ['46.318730', '41.760780'],
-    ['46.388690', '41.818530'],
-    ['46.423670', '41.863200'],
-    ['46.436160', '41.911560'],
-    ['46.421170', '41.948740'],
-    ['46.338720', '41.965460'],
-    ['46.266260', '42.019310'],
-    ['46.181310', '42.030450'],
-    ['46.103860', '42.043440'],
-    ['45.988930', '42.060140'],
-    ['45.923960', '42.100930'],
-    ['45.866500', '42.132440'],
-    ['45.801540', '42.138000'],
-    ['45.726580', '42.178750'],
-    ['45.659120', '42.213920'],
-    ['45.654120', '42.258310'],
-    ['45.716590', '42.269410'],
-    ['45.774050', '42.284200'],
-    ['45.786540', '42.326700'],
-    ['45.766560', '42.363630'],
-    ['45.781550', '42.420830'],
-    ['45.801540', '42.466930'],
-    ['45.791540', '42.498250'],
-    ['45.701590', '42.512990'],
-    ['45.616640', '42.544290'],
-    ['45.569170', '42.555330'],
-    ['45.449240', '42.559020'],
-    ['45.361790', '42.557170'],
-    ['45.329310', '42.592130'],
-    ['45.241860', '42.676690'],
-    ['45.169410', '42.718920'],
-    ['45.076960', '42.744620'],
-    ['44.997220', '42.754370'],
-    ['45.000000', '75.000000'],
-    ['39.671880', '81.472990'],
-    ['-5.863332', '81.434750']]
-
-europe_polygon_geom = Polygon(europe_lon_lat_list) # type: ignore
-europe_polygon = gpd.GeoDataFrame(index=[0], crs='epsg:4326', geometry=[europe_polygon_geom])
-
-countries = {
-    'Akrotiri': 3267302,
-    'Åland Islands': 2375170,
-    'Albania': 53292,
-    'Andorra': 9407,
-    'Armenia': 364066,
-    'Austria': 16239,
-    'Azerbaijan': 364110,
-    'Belarus': 59065,
-    'Belgium': 52411,
-    'Bosnia and Herzegovina': 214908,
-    'Bulgaria': 186382,
-    'Croatia': 214885,
-    'Cyprus': 307787,
-    'Czech Republic': 51684,
-    'Denmark': 50046,
-    'Dhekelia': 3267303,
-    'Estonia': 79510,
-    'Faroe Islands': 52939,
-    'Finland': 54224,
-    'France': 2202162,
-    'Georgia': 28699,
-    'Germany': 51477,
-    'Gibraltar': 1278736,
-    'Greece': 192307,
-    'Guernsey': 270009,
-    'Hungary': 21335,
-    'Iceland': 299133,
-    'Ireland': 62273,
-    'Isle of Man': 62269,
-    'Italy': 365331,
-    'Jersey': 367988,
-    'Kazakhstan': 214665,
-    'Kosovo': 2088990,
-    'Latvia': 72594,
-    'Liechtenstein': 1155955,
-    'Lithuania': 72596,
-    'Luxembourg': 28711,
-    'North Macedonia': 53293,
-    'Malta': 365307,
-    'Moldova': 58974,
-    'Monaco': 1124039,
-    'Montenegro': 53296,
-    'Netherlands': 47796,
-    'Norway': 1059668,
-    'Poland': 49715,
-    'Portugal': 295480,
-    'Romania': 90689,
-    # 'Russia': 60189,
-    'San Marino': 54624,
-    'Serbia': 1741311,
-    'Slovakia': 14296,
-    'Slovenia': 218657,
-    'Spain': 1311341,
-    'Sweden': 52822,
-    'Switzerland': 51701,
-    'Turkey': 174737,
-    'Ukraine': 60199,
-    'United Kingdom': 51684,
-    'Vatican': 36989
-}
-
-countries_count = len(countries)
-
-
-@retry(wait_random_min=30000, wait_random_max=60000, stop_max_attempt_number=10)
-def get_data(url):
-    print(url)
-    response = requests.get(url)
-    if response.status_code == 200:
-        return response.json()['elements']
-    raise requests.ConnectionError
-
-
-def generate_gpx(array, points_series, name):
     with contextlib.suppress(FileNotFoundError):
-        os.remove(f'gpx/{name}.gpx')
-    poi = gpd.GeoDataFrame(array, geometry=points_series, crs='epsg:4326').drop_duplicates()
-    poi = gpd.sjoin(poi, europe_polygon, predicate='within').dropna(axis=1).drop('index_right', axis=1)
-    poi.to_file(f"gpx/{name}.gpx", "GPX", engine="fiona")
-    return
-
-
-def average_speed(_progress, _task_id):
-    data = []
-    for i, (_, relationid) in enumerate(countries.items(), start=1):
-        data += get_data(f'https://overpass-api.de/api/interpreter?data=[out:json][timeout:300];area(id:{3600000000+relationid})->.searchArea;nwr["enforcement"="average_speed"](area.searchArea);out geom;')
-        _progress[_task_id] = {"progress": i + 1, "total": countries_count+1}
-
-    tmp = [i for j in data for i in j.get('members', {}) if j.get('members') and i.get('role') in ['from', 'to'] and i.get('type') != 'way']
-    tmp += [j for j in data if j.get('type') == 'node' and j.get('lon')]
-
-    if tmp:
-        points_array = [Point(x['lon'], x['lat']) for x in tmp]
-        points_series = gpd.GeoSeries(points_array)
-        array = [{"name": "Average speed camera"} for _ in points_array]
-        generate_gpx(array, points_series, inspect.currentframe().f_code.co_name) # type: ignore
-        _progress[_task_id] = {"progress": 1, "total": 1}
-    return
-
-
-def fuel_stations(_progress, _task_id):
-    data = []
-    for i, (_, relationid) in enumerate(countries.items(), start=1):
-        data += get_data(f'https://overpass-api.de/api/interpreter?data=[out:json][timeout:300];area(id:{3600000000+relationid})->.searchArea;nwr["amenity"="fuel"](area.searchArea);convert item ::=::,::geom=geom(),_osm_type=type();out center;')
-        _progress[_task_id] = {"progress": i + 1, "total": countries_count+1}
-
-    if data:
-        points_array = [Point(x["geometry"]["coordinates"][0], x["geometry"]["coordinates"][1]) for x in data if 'node/' not in x.get('tags').get('name', 'node/')]
-        points_series = gpd.GeoSeries(points_array)
-        array = [{"name": x["tags"].get("brand", x["tags"].get("name", "node/"))} for x in data if 'node/' not in x.get('tags').get('name', 'node/')]
-        generate_gpx(array, points_series, inspect.currentframe().f_code.co_name) # type: ignore
-        _progress[_task_id] = {"progress": 1, "total": 1}
-        return
-
-
-def speed_bumps(_progress, _task_id):
-    data = []
-    for i, (_, relationid) in enumerate(countries.items(), start=1):
-        data += get_data(f'https://overpass-api.de/api/interpreter?data=[out:json][timeout:300];area(id:{3600000000+relationid})->.searchArea;nwr["traffic_calming"](area.searchArea);out center;')
-        _progress[_task_id] = {"progress": i + 1, "total": countries_count+1}
-
-    if data:
-        points_array = [Point(x["lon"], x["lat"]) for x in data if x["type"] == "node"]
-        points_series = gpd.GeoSeries(points_array)
-        array = [{"name": "Speed bump"} for _ in points_array]
-        generate_gpx(array, points_series, inspect.currentframe().f_code.co_name) # type: ignore
-        _progress[_task_id] = {"progress": 1, "total": 1}
-        return
-
-
-def rail_crossings(_progress, _task_id):
-    data = []
-    for i, (_, relationid) in enumerate(countries.items(), start=1):
-        data += get_data(f'https://overpass-api.de/api/interpreter?data=[out:json][timeout:300];area(id:{3600000000+relationid})->.searchArea;nwr["railway"="level_crossing"](area.searchArea);out center;')
-        _progress[_task_id] = {"progress": i + 1, "total": countries_count+1}
-
-    if data:
-        points_array = [Point(x["lon"], x["lat"]) for x in data if x["type"] == "node"]
-        points_series = gpd.GeoSeries(points_array)
-        array = [{"name": "Rail crossing"} for _ in points_array]
-        generate_gpx(array, points_series, inspect.currentframe().f_code.co_name) # type: ignore
-        _progress[_task_id] = {"progress": 1, "total": 1}
-        return
-
-
-def speed_cameras(_progress, _task_id):
-    data = []
-    for i, (_, relationid) in enumerate(countries.items(), start=1):
-        data += get_data(f'https://overpass-api.de/api/interpreter?data=[out:json][timeout:300];area(id:{3600000000+relationid})->.searchArea;nwr["highway"="speed_camera"](area.searchArea);out center;')
-        _progress[_task_id] = {"progress": i + 1, "total": countries_count+1}
-
-    if data:
-        points_array = [Point(x["lon"], x["lat"]) for x in data if x["type"] == "node"]
-        points_series = gpd.GeoSeries(points_array)
-        array = [{"name": "Speed camera"} for _ in points_array]
-        generate_gpx(array, points_series, inspect.currentframe().f_code.co_name) # type: ignore
-        _progress[_task_id] = {"progress": 1, "total": 1}
-        return
-
-
-def fast_food(_progress, _task_id):
-    data = []
-    for i, (_, relationid) in enumerate(countries.items(), start=1):
-        data += get_data(f'https://overpass-api.de/api/interpreter?data=[out:json][timeout:300];area(id:{3600000000+relationid})->.searchArea;nwr["amenity"="fast_food"](area.searchArea);convert item ::=::,::geom=geom(),_osm_type=type();out center;')
-        _progress[_task_id] = {"progress": i + 1, "total": countries_count+1}
-
-    if data:
-        wanted = ["McDonald's", "Burger King", "Subway", "KFC", "Max Premium Burgers"]
-        points_array = [Point(x["geometry"]["coordinates"][0], x["geometry"]["coordinates"][1]) for x in data if x.get('tags', {}).get('brand') in wanted]
-        points_series = gpd.GeoSeries(points_array)
-        array = [{"name": x.get('tags', {}).get('brand')} for x in data if x.get('tags', {}).get('brand') in wanted]
-        generate_gpx(array, points_series, inspect.currentframe().f_code.co_name) # type: ignore
-        _progress[_task_id] = {"progress": 1, "total": 1}
-        return
+        os.remove(f'gpx/{region.name}/{name}.gpx')
+    if export_gpx:
+        os.makedirs(f'gpx/{region.name}', exist_ok=True)
+        with tracing.span('write_gpx', rows=len(poi)):
+            gpx = gpd.GeoDataFrame({"name": poi['name']}, geometry=gpd.points_from_xy(poi['lon'], poi['lat']), crs='epsg:4326')
+            gpx.to_file(f"gpx/{region.name}/{name}.gpx", "GPX", engine="fiona")
+
+
+def process(category, data, regions, export_gpx):
+    with tracing.span('process', stage=True, category=category.name, rows=len(data)):
+        with tracing.span('select') as span:
+            result = category.select(data)
+            span.rows(0 if result is None else len(result[0]))
+        if result is not None:
+            with tracing.span('merge_nearby', radius=category.radius) as span:
+                result = category.dedupe(*result)
+                span.rows(len(result[0]))
+            # One selection feeds every region
+            for region in regions:
+                generate(*result, category, region, export_gpx)
+
+
+def fetch(categories, regions, union, concurrency, executor, export_gpx=False, datasets=None, plan=None, budget=0):
+    ''' Fetch every (category, area) query from one event loop and submit each category's
+        post-processing to the executor as soon as all of its areas are in. The areas are
+        the tiles of a tiles.Plan, split further when a tile times out or its result
+        exceeds budget rows, or the areas of the regions without a plan.
+        With a DatasetStore, categories fetched before only download the elements changed
+        since then plus the ids of all matching elements, and are merged into the stored dataset.
+        Progress is reported as 'fetched' events.
+    '''
+    category = {i.name: i for i in categories}
+    groups = [tuple(category)] if union else [(name,) for name in category]
+    (_, countries) = coverage(regions)
+    scope = plan.region if plan is not None else countries
+    fingerprints = {name: fingerprint(category[name].statement, category[name].tags, scope) for name in category}
+    previous = {name: datasets.load(name, fingerprints[name]) for name in category} if datasets is not None else {}
+
+    def statements(name):
+        if previous.get(name) is None:
+            return {name: category[name].statement}
+        since = previous[name][0].timestamp
+        return {name: overpass.changed_statement(category[name].statement, since), f'{name}:ids': overpass.ids_statement(category[name].statement)}
+
+    def stores(name):
+        return {name: category[name].tags, f'{name}:ids': []} if previous.get(name) is not None else {name: category[name].tags}
+
+    def job(group, area):
+        # The changes and the id listing must be as of now, so they bypass the response cache
+        return ((group, area), overpass.union_query(area, {k: v for name in group for k, v in statements(name).items()}),
+                {k: v for name in group for k, v in stores(name).items()},
+                all(previous.get(name) is None for name in group))
+
+    areas = {group: plan.tiles(','.join(group)) if plan is not None else list(dict.fromkeys(countries.values())) for group in groups}
+    jobs = [job(group, area) for group in groups for area in areas[group]]
+    outstanding = {group: len(areas[group]) for group in groups}
+    total = {name: len(areas[group]) for group in groups for name in group}
+
+    data = {name: Elements(category[name].tags) for name in category}
+    listing = {name: Elements() for name in category}
+    timestamps = {name: [] for name in category}
+    fetched = dict.fromkeys(category, 0)
+    futures = []
+
+    def complete(name):
+        elements = data.pop(name)
+        elements.timestamp = None if None in timestamps[name] else min(timestamps[name])
+        full = time.time()
+        if previous.get(name) is not None:
+            (snapshot, full) = previous.pop(name)
+            print(f'{name}: {len(elements)} changed rows since {snapshot.timestamp}')
+            with tracing.span('merge', category=name, changed=len(elements)) as span:
+                elements = merge(snapshot, listing.pop(name), elements)
+                span.rows(len(elements))
+        if datasets is not None:
+            with tracing.span('save_dataset', category=name, rows=len(elements)):
+                datasets.save(name, fingerprints[name], elements, full)
+        futures.append(executor.submit(process, category[name], elements, regions, export_gpx))
+
+    async def run():
+        async for (group, area), results in overpass.fetch_all(jobs, concurrency):
+            if isinstance(results, IncompleteResponse):
+                if plan is None or area.north - area.south <= tiles.MIN_SIZE:
+                    raise results
+                print(f'{",".join(group)} ({area.bbox()}): {results} Splitting the tile.')
+                children = plan.split(','.join(group), area)
+                jobs.extend(job(group, child) for child in children)
+                outstanding[group] += len(children) - 1
+                for name in group:
+                    total[name] += len(children) - 1
+                    events.emit('fetched', name=name, completed=fetched[name], total=total[name])
+                continue
+
+            if plan is not None:
+                # Smaller tiles next time, and keep only the elements this tile owns
+                depth = tiles.levels(sum(len(elements) for name, elements in results.items() if name in category), budget)
+                if depth:
+                    plan.split(','.join(group), area, depth)
+                results = {name: elements.select(area.owns(*elements.anchors())) if name in category else elements
+                           for name, elements in results.items()}
+
+            for key, elements in results.items():
+                if key.endswith(':ids'):
+                    listing[key[:-4]].extend(elements)
+            outstanding[group] -= 1
+            for name, elements in results.items():
+                if name in category:
+                    data[name].extend(elements)
+                    timestamps[name].append(elements.timestamp)
+                    fetched[name] += 1
+                    events.emit('fetched', name=name, completed=fetched[name], total=total[name])
+                    if outstanding[group] == 0:
+                        complete(name)
+
+    try:
+        asyncio.run(run())
+    finally:
+        if plan is not None:
+            plan.save()
+    return futures
+
+
+def read_extract(path, categories, regions, executor, export_gpx=False):
+    ''' Read every category from a local .osm.pbf extract instead of Overpass and submit
+        its post-processing to the executor. The extract is not clipped to the areas;
+        generate() keeps what lies within each region.
+    '''
+    category = {i.name: i for i in categories}
+    with tracing.span('read_pbf'):
+        data = pbf.read(path, {name: (category[name].statement, category[name].tags) for name in category}) if category else {}
+    futures = []
+    for name, elements in data.items():
+        events.emit('fetched', name=name, completed=1, total=1)
+        futures.append(executor.submit(process, category[name], elements, regions, export_gpx))
+    return futures
+
+
+def build_region(config_file, region, categories):
+    ''' Build the databases of region from its data/<region> bundles and write its package.
+        Returns the path of the zip.
+    '''
+    with tracing.span('build_region', stage=True, region=region.name):
+        output = mypois.read_config(config_file).get('General', 'OutputDirectory', fallback='output')
+        sources = {category.name: f'data/{region.name}/{category.name}.poi' for category in categories}
+        with tracing.span('mypois'):
+            targets = mypois.create_mypois(config_file, fix=False, dest=os.path.join(output, region.name),
+                                           sources=sources, title=region.title)
+        # Checksums are computed while the archive is written
+        path = os.path.join(output, f'{region.package}.zip')
+        with tracing.span('package'):
+            package.write_package(os.path.join(output, region.name), path, fix=targets)
+    return path
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--offline', action='store_true', help='serve Overpass responses from the cache only')
+    parser.add_argument('--pbf', metavar='FILE', help='read the data from a local .osm.pbf extract instead of Overpass')
+    parser.add_argument('--full', action='store_true', help='fetch every category in full instead of only the changes since the last run')
+    parser.add_argument('--trace', metavar='FILE', help='write a Chrome trace (JSON) of the build stages to FILE')
+    parser.add_argument('--profile', metavar='DIR', help='with --trace, also write a cProfile dump of every stage to DIR')
+    parser.add_argument('--trace-memory', action='store_true', help='with --trace, also record tracemalloc allocations (slow)')
+    args = parser.parse_args()
+
+    if args.trace:
+        tracing.enable(args.trace, args.profile, args.trace_memory)
+        # Keep what was traced when the build fails
+        atexit.register(tracing.finish)
+
     config = configparser.ConfigParser()
     config.optionxform = str # type: ignore
     config.read_file(open('config.ini'))
 
-    print('Downloading data')
+    categories = read_categories(config)
+    union = config.getboolean('General', 'UnionQuery', fallback=False)
+    concurrency = config.getint('General', 'FetchConcurrency', fallback=4)
+    export_gpx = config.getboolean('General', 'ExportGPX', fallback=False)
+    overpass.configure_cache(config.get('General', 'CacheDirectory', fallback='cache'),
+                             config.getfloat('General', 'CacheTTL', fallback=144) * 3600,
+                             config.getint('General', 'CacheSize', fallback=4096) * 1024 ** 2,
+                             args.offline)
+    overpass.configure_client(concurrency,
+                              config.getfloat('General', 'ConnectTimeout', fallback=10),
+                              config.getfloat('General', 'ReadTimeout', fallback=330),
+                              config.getint('General', 'FetchAttempts', fallback=6))
+    regions = read_regions([name.strip() for name in config.get('General', 'Regions', fallback='Europe').split(',') if name.strip()])
+    (polygon, _) = coverage(regions)
+    plan = None
+    if config.getboolean('General', 'Tiling', fallback=True):
+        plan = tiles.Plan(polygon, config.getfloat('General', 'TileSize', fallback=8),
+                          os.path.join(config.get('General', 'CacheDirectory', fallback='cache'), 'tiles.json'))
+    datasets = None
+    if config.getboolean('General', 'Incremental', fallback=False) and not args.offline:
+        datasets = DatasetStore(os.path.join(config.get('General', 'CacheDirectory', fallback='cache'), 'datasets'),
+                                0 if args.full else config.getfloat('General', 'FullRefreshDays', fallback=28) * 24 * 3600)
+
+    print('Reading extract' if args.pbf else 'Downloading data')
 
     with progress.Progress("[progress.description]{task.description}", progress.BarColumn(), "[progress.percentage]{task.percentage:>3.0f}%", progress.TimeRemainingColumn(), progress.TimeElapsedColumn(), refresh_per_second=1) as progress:
-        futures = []
-        with multiprocessing.Manager() as manager:
-            _progress = manager.dict()
-            overall_progress_task = progress.add_task("[green]All jobs progress:")
-            with ProcessPoolExecutor(max_workers=8) as executor:
-                for i in [eval(f) for f in config.sections() if f != 'General']:
-                    task_id = progress.add_task(f"{i.__name__}")
-                    futures.append(executor.submit(i, _progress, task_id))
-
-                ci_percent, ci_percent_last = 0.0, 0.0
-
-                while (n_finished := sum(future.done() for future in futures)) < len(futures):
-                    progress.update(overall_progress_task, completed=n_finished, total=len(futures)+2)
-                    processed,total = 0,0
-                    for task_id, update_data in _progress.items():
-                        progress.update(task_id, completed=update_data["progress"], total=update_data["total"])
-                        processed+=update_data["progress"]
-                        total+=update_data["total"]
-
-                    ci_percent = round(float((total and processed/total or 0) * 100), 2)
-                    if ci_percent > ci_percent_last:
-                        print(f'Progress: {ci_percent}%')
-                        ci_percent_last = ci_percent
-
-                for future in futures:
+        overall_progress_task = progress.add_task("[green]All jobs progress:")
+        tasks = {i.name: progress.add_task(i.name, total=None) for i in categories}
+        fetched = dict.fromkeys(tasks, 0.0)
+        stats = events.Stats()
+        ci_percent_last = 0.0
+
+        def report(kind, fields):
+            # Called for every event, in the main process and one at a time
+            global ci_percent_last
+            stats.add(kind, fields)
+            progress.update(overall_progress_task, description=f"[green]All jobs progress: {stats.summary()}")
+            if kind != 'fetched':
+                return
+            progress.update(tasks[fields['name']], completed=fields['completed'], total=fields['total'])
+            fetched[fields['name']] = fields['completed'] / fields['total']
+            ci_percent = round(sum(fetched.values()) / len(fetched) * 100, 2)
+            if ci_percent > ci_percent_last:
+                print(f'Progress: {ci_percent}% | {stats.summary()}')
+                ci_percent_last = ci_percent
+
+        with events.Channel(report), ProcessPoolExecutor(max_workers=8, **events.worker_args()) as executor:
+            with tracing.span('fetch', stage=True):
+                if args.pbf:
+                    futures = read_extract(args.pbf, categories, regions, executor, export_gpx)
+                else:
+                    futures = fetch(categories, regions, union, concurrency, executor, export_gpx, datasets, plan,
+                                    config.getint('General', 'TileBudget', fallback=200000))
+            n_finished = 0
+            progress.update(overall_progress_task, completed=n_finished, total=len(futures)+len(regions))
+            with tracing.span('wait_processing'):
+                for n_finished, future in enumerate(as_completed(futures), start=1):
                     future.result()
+                    progress.update(overall_progress_task, completed=n_finished, total=len(futures)+len(regions))
+        print(f'Fetched: {stats.summary()}')
 
         print('Generating data and file')
 
-        mypois.main()
-        progress.update(overall_progress_task, completed=n_finished+1, total=len(futures)+3)
-
-        [os.remove(f) for f in glob.glob('output/*.zip')]
-        f_name = 'OSM_POI_Europe'
-        shutil.make_archive(f'{f_name}', 'zip', 'output', '.')
-        shutil.move(f'{f_name}.zip', 'output/')
+        # The regions are built from the same data, in parallel when there are several
+        if len(regions) == 1:
+            print(f'Package written to {build_region("config.ini", regions[0], categories)}')
+        else:
+            with events.Channel(report), ProcessPoolExecutor(max_workers=min(len(regions), os.cpu_count() or 1),
+                                                             **events.worker_args()) as executor:
+                builds = [executor.submit(build_region, 'config.ini', region, categories) for region in regions]
+                for n_finished, future in enumerate(as_completed(builds), start=n_finished+1):
+                    print(f'Package written to {future.result()}')
+                    progress.update(overall_progress_task, completed=n_finished, total=len(futures)+len(regions))
 
         print('Done')
 
         progress.update(overall_progress_task, completed=1, total=1)
+
+    if args.trace:
+        print(f'Trace written to {tracing.finish()}')
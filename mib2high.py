@@ -1,13 +1,18 @@
 from __future__ import print_function
 
+import functools
+import json
 import os
-import sqlite3
 import xml.etree.cElementTree as cElementTree
 
 import pandas
-from PIL import Image
 
+import bulkload
+import optimize
+import tracing
 import utils
+from assets import AssetCache
+from morton import encode_morton_codes
 
 '''
 
@@ -23,13 +28,15 @@ Note: The poiname table does not have an explicit poiid field. So we will need t
 
 
 class MIB2HIGH(object):
-    def __init__(self, dest):
+    def __init__(self, dest, assets=None, title=None):
         self.dest = dest
+        self.title = title or 'OSM POI Europe'
         self.db = os.path.join(dest, 'PersonalPOI', 'Package', '0', 'default', 'poidata.db')
+        self.assets = assets if assets is not None else AssetCache()
 
     def open(self):
 
-        self.conn = sqlite3.connect(self.db)
+        self.conn = bulkload.connect(self.db)
 
         cursor = self.conn.cursor()
 
@@ -40,49 +47,112 @@ class MIB2HIGH(object):
         cursor.execute(
             'create table if not exists "poidata" (poiid INTEGER,type INTEGER,namephon TEXT,ccode INTEGER,zipcode TEXT,city TEXT,street TEXT,housenr TEXT,phone TEXT,ntlimportance INTEGER,exttype TEXT,extcont TEXT,warning TEXT,warnphon TEXT,CONSTRAINT PK_poidata PRIMARY KEY (poiid))')
 
-        self.conn.commit()
-
         # Create the Update.txt file
         utils.create_update_dot_txt(os.path.join(self.dest, 'PersonalPOI', 'InfoFile', '0', 'default', 'Update.txt'),
-                                    name='OSM POI Europe')
+                                    name=self.title)
 
-        # Start creating the categories.pc xml file
-        self.poicategories = cElementTree.Element('poicategories', {'version': '02010011'})
-        self.poicategories_categories = cElementTree.SubElement(self.poicategories, 'categories')
-        self.poicategories_types = cElementTree.SubElement(self.poicategories, 'types')
-        self.poicategories_search = cElementTree.SubElement(self.poicategories, 'search', {'type': 'Generic'})
+        # The categories read so far, written to the xml files on close
+        self.categories = []
         self.next_category = 0
 
-        # Start creating the strings_de-DE.xml file
-        self.poistrings = cElementTree.Element('strings')
-
-        # Start creating the bitmaps.xml file
-        self.poibitmaps = cElementTree.Element('bitmaps', {'count': str(self.next_category)})
-
     def close(self):
-        self.conn.close()
+        bulkload.close(self.conn)
+
+        # The xml files only depend on the categories, so they are cached as assets
+        content = json.dumps(self.categories).encode('utf-8')
+        self.trees = None
+        for filename in ('categories.pc', 'strings_de-DE.xml', 'bitmaps.xml'):
+            self.assets.install(f'mib2high/{filename}', content, functools.partial(self.write_manifest, filename),
+                                os.path.join(self.dest, 'PersonalPOI', 'Package', '0', 'default', filename))
+
+    def optimize(self, page_size=optimize.PAGE_SIZE):
+        ''' Rewrite the closed database in Morton order within each category, see optimize.py '''
+        conn = bulkload.connect(self.db)
+        df = pandas.read_sql_query('select d.poiid, d.type, c.latmin, c.lonmin from "poidata" d join "poicoord" c on c.poiid = d.poiid', conn)
+        bulkload.close(conn)
+        ids = optimize.spatial_order(df['poiid'], df['type'], encode_morton_codes(df['latmin'], df['lonmin']))
+        # The poiname rows are matched by their rowid
+        optimize.rewrite(self.db, ids, {'poicoord': 'poiid', 'poiname': 'rowid', 'poidata': 'poiid'}, page_size)
+
+    def manifests(self):
+        ''' Build the categories.pc, strings_de-DE.xml and bitmaps.xml trees of the categories read '''
 
-        # Write out the poicategories
-        # WARNING: This does NOT add standalone="yes" to the xml declaration...
-        utils.indent(self.poicategories)
-        cElementTree.ElementTree(self.poicategories).write(
-            os.path.join(self.dest, 'PersonalPOI', 'Package', '0', 'default', 'categories.pc'), encoding='utf-8',
-            xml_declaration=True)
+        # Start creating the categories.pc xml file
+        poicategories = cElementTree.Element('poicategories', {'version': '02010011'})
+        poicategories_categories = cElementTree.SubElement(poicategories, 'categories')
+        poicategories_types = cElementTree.SubElement(poicategories, 'types')
+        poicategories_search = cElementTree.SubElement(poicategories, 'search', {'type': 'Generic'})
 
-        # Write out the poistrings
-        # WARNING: This does NOT add standalone="yes" to the xml declaration...
-        utils.indent(self.poistrings)
-        cElementTree.ElementTree(self.poistrings).write(
-            os.path.join(self.dest, 'PersonalPOI', 'Package', '0', 'default', 'strings_de-DE.xml'), encoding='utf-8',
-            xml_declaration=True)
+        # Start creating the strings_de-DE.xml file
+        poistrings = cElementTree.Element('strings')
 
-        # Write out the poibitmaps
+        # Start creating the bitmaps.xml file
+        poibitmaps = cElementTree.Element('bitmaps', {'count': str(len(self.categories))})
+
+        for (next_category, entry) in enumerate(self.categories):
+            icon_str = f'bitmaps/{entry["icon"]},0,0,39,39,-19,-39'
+            warning = entry['warning']
+            if entry['shadow']:
+                # shadow_2d_str = f'bitmaps/SHADOW_2D_{entry["shadow"]}.png,0,0,44,44,-19,-39'
+                shadow_3d_str = f'bitmaps/SHADOW_3D_{entry["shadow"]}.png,0,0,39,46,-19,-39'
+                if entry['shadow'] == 'CIRCLE':
+                    # res_id_2d = '20001'
+                    res_id_3d = '20003'
+                else:
+                    # res_id_2d = '20002'
+                    res_id_3d = '20004'
+
+            # Update categories.pc
+            # categories
+            category = cElementTree.SubElement(poicategories_categories, 'category',
+                                               {'bitmapIndex': str(next_category + 1),
+                                                'warnable': 'true' if warning else 'false', 'name': str(next_category),
+                                                'id': str(next_category + 1000)})
+            bitmap = cElementTree.SubElement(category, 'bitmap', {'res_id': str(next_category + 1)})
+            bitmap.text = icon_str
+            # types
+            type_ = cElementTree.SubElement(poicategories_types, 'type', {'id': str(next_category)})
+            bitmap = cElementTree.SubElement(type_, 'bitmap',
+                                             {'res_id': str(next_category + 1), 'size': '10', 'module': '0'})
+            bitmap.text = icon_str
+            bitmap = cElementTree.SubElement(type_, 'bitmap',
+                                             {'res_id': str(next_category + 1), 'size': '10', 'module': '1'})
+            bitmap.text = icon_str
+
+            if entry['shadow']:
+                # bitmap = cElementTree.SubElement(type_,'bitmap',{ 'res_id':res_id_2d, 'size':'10', 'module':'0', 'type': '4'})
+                # bitmap.text=shadow_2d_str
+                bitmap = cElementTree.SubElement(type_, 'bitmap',
+                                                 {'res_id': res_id_3d, 'size': '10', 'module': '0', 'type': '5'})
+                bitmap.text = shadow_3d_str
+
+            zoomlevel = cElementTree.SubElement(type_, 'zoomlevel', {'max': '60', 'min': '0'})
+            priority = cElementTree.SubElement(type_, 'priority')
+            priority.text = entry['priority']
+            code = cElementTree.SubElement(type_, 'code')
+            code.text = str(next_category)
+            # search xml
+            category = cElementTree.SubElement(poicategories_search, 'category',
+                                               {'index': entry['index'], 'id': str(next_category + 1000)})
+            type_ = cElementTree.SubElement(category, 'type', {'id': str(next_category)})
+
+            # Update strings_de-DE.xml
+            string = cElementTree.SubElement(poistrings, 'string', {'type': '0', 'id': str(next_category)})
+            lang = cElementTree.SubElement(string, 'lang', {'lang': 'de-DE'})
+            text = cElementTree.SubElement(lang, 'text')
+            text.text = entry['name']
+
+            # Update bitmaps.xml
+            cElementTree.SubElement(poibitmaps, 'resource', {'id': str(next_category + 1), 'name': icon_str})
+
+        return {'categories.pc': poicategories, 'strings_de-DE.xml': poistrings, 'bitmaps.xml': poibitmaps}
+
+    def write_manifest(self, filename, path):
+        if self.trees is None:
+            self.trees = self.manifests()
         # WARNING: This does NOT add standalone="yes" to the xml declaration...
-        utils.indent(self.poibitmaps)
-        self.poibitmaps.attrib['count'] = str(self.next_category)
-        cElementTree.ElementTree(self.poibitmaps).write(
-            os.path.join(self.dest, 'PersonalPOI', 'Package', '0', 'default', 'bitmaps.xml'), encoding='utf-8',
-            xml_declaration=True)
+        utils.indent(self.trees[filename])
+        cElementTree.ElementTree(self.trees[filename]).write(path, encoding='utf-8', xml_declaration=True)
 
     def read(self, config, section):
         name = config.get(section, 'Name')
@@ -100,74 +170,20 @@ class MIB2HIGH(object):
         (_, icon_extension) = os.path.splitext(src_icon)
         dst_icon = '%03d_image.png' % self.next_category
         # Convert the image to a 39x39 png image (we have not tested whether any other sizes/formats are supported)
-        icon_str = f'bitmaps/{dst_icon},0,0,39,39,-19,-39'
-        img = Image.open(src_icon)
-        if any(i > 39 for i in img.size):
-            img.thumbnail((39, 39), Image.LANCZOS)
-        img.save(os.path.join(self.dest, 'PersonalPOI', 'Package', '0', 'default', 'bitmaps', dst_icon))
+        self.assets.icon(src_icon, os.path.join(self.dest, 'PersonalPOI', 'Package', '0', 'default', 'bitmaps', dst_icon))
 
         # Shadows
-        if config.get(section, 'Shadow'):
-            shadow_name = config.get(section, 'Shadow').upper()
+        shadow_name = config.get(section, 'Shadow').upper() if config.get(section, 'Shadow') else None
+        if shadow_name:
             # shadow_2d = f'SHADOW_2D_{shadow_name}.png'
             shadow_3d = f'SHADOW_3D_{shadow_name}.png'
-            # shadow_2d_str = f'bitmaps/{shadow_2d},0,0,44,44,-19,-39'
-            shadow_3d_str = f'bitmaps/{shadow_3d},0,0,39,46,-19,-39'
-            # img=Image.open(f'img/{shadow_2d}')
-            # img.save(os.path.join(self.dest,'PersonalPOI','Package','0','default','bitmaps',shadow_2d))
-            img = Image.open(f'img/{shadow_3d}')
-            img.save(os.path.join(self.dest, 'PersonalPOI', 'Package', '0', 'default', 'bitmaps', shadow_3d))
-            if shadow_name == 'CIRCLE':
-                # res_id_2d = '20001'
-                res_id_3d = '20003'
-            else:
-                # res_id_2d = '20002'
-                res_id_3d = '20004'
+            # self.assets.image(f'img/{shadow_2d}', os.path.join(self.dest,'PersonalPOI','Package','0','default','bitmaps',shadow_2d))
+            self.assets.image(f'img/{shadow_3d}', os.path.join(self.dest, 'PersonalPOI', 'Package', '0', 'default', 'bitmaps', shadow_3d))
 
         # print('MIB2HIGH New Category: %d "%s" %d "%s" => "%s"' % (self.next_category, name, warning, src_icon, dst_icon))
 
-        # Update categories.pc
-        # categories
-        category = cElementTree.SubElement(self.poicategories_categories, 'category',
-                                           {'bitmapIndex': str(self.next_category + 1),
-                                            'warnable': 'true' if warning else 'false', 'name': str(self.next_category),
-                                            'id': str(self.next_category + 1000)})
-        bitmap = cElementTree.SubElement(category, 'bitmap', {'res_id': str(self.next_category + 1)})
-        bitmap.text = icon_str
-        # types
-        type_ = cElementTree.SubElement(self.poicategories_types, 'type', {'id': str(self.next_category)})
-        bitmap = cElementTree.SubElement(type_, 'bitmap',
-                                         {'res_id': str(self.next_category + 1), 'size': '10', 'module': '0'})
-        bitmap.text = icon_str
-        bitmap = cElementTree.SubElement(type_, 'bitmap',
-                                         {'res_id': str(self.next_category + 1), 'size': '10', 'module': '1'})
-        bitmap.text = icon_str
-
-        if config.get(section, 'Shadow'):
-            # bitmap = cElementTree.SubElement(type_,'bitmap',{ 'res_id':res_id_2d, 'size':'10', 'module':'0', 'type': '4'})
-            # bitmap.text=shadow_2d_str
-            bitmap = cElementTree.SubElement(type_, 'bitmap',
-                                             {'res_id': res_id_3d, 'size': '10', 'module': '0', 'type': '5'})
-            bitmap.text = shadow_3d_str
-
-        zoomlevel = cElementTree.SubElement(type_, 'zoomlevel', {'max': '60', 'min': '0'})
-        priority = cElementTree.SubElement(type_, 'priority')
-        priority.text = category_priority
-        code = cElementTree.SubElement(type_, 'code')
-        code.text = str(self.next_category)
-        # search xml
-        category = cElementTree.SubElement(self.poicategories_search, 'category',
-                                           {'index': category_index, 'id': str(self.next_category + 1000)})
-        type_ = cElementTree.SubElement(category, 'type', {'id': str(self.next_category)})
-
-        # Update strings_de-DE.xml
-        string = cElementTree.SubElement(self.poistrings, 'string', {'type': '0', 'id': str(self.next_category)})
-        lang = cElementTree.SubElement(string, 'lang', {'lang': 'de-DE'})
-        text = cElementTree.SubElement(lang, 'text')
-        text.text = name
-
-        # Update bitmaps.xml
-        cElementTree.SubElement(self.poibitmaps, 'resource', {'id': str(self.next_category + 1), 'name': icon_str})
+        self.categories.append({'name': name, 'warning': warning, 'icon': dst_icon, 'shadow': shadow_name,
+                                'index': category_index, 'priority': category_priority})
 
         #
         ccode = 0
@@ -176,32 +192,27 @@ class MIB2HIGH(object):
         cursor.execute('select max(rowid) from "poicoord"')
         (lastrowid,) = cursor.fetchone()
         startpoiid = 0 if lastrowid is None else lastrowid + 1
-        df = utils.read_geo(source)
-
-        # print('Read %d entries' % len(df))
-
-        # Build the poicoord table
-        poicoord = pandas.DataFrame()
-        # poicoord.insert(0,'poiid',range(startpoiid,startpoiid+len(poicoord)))
-        poicoord['poiid'] = range(startpoiid, startpoiid + len(df))
-        poicoord['lonmin'] = df['lon']
-        poicoord['lonmax'] = df['lon']
-        poicoord['latmin'] = df['lat']
-        poicoord['latmax'] = df['lat']
-        # poicoord=poicoord.drop(columns=['name','lat','lon'])
-        poicoord.to_sql(name='poicoord', con=self.conn, if_exists='append', index=False)
-
-        # Build the poiname table
-        poiname = pandas.DataFrame()
-        poiname['rowid'] = range(startpoiid, startpoiid + len(df))  # Explicitly specify the rowid..
-        poiname['name'] = df['name']
-        poiname.to_sql(name='poiname', con=self.conn, if_exists='append', index=False)
-
-        # Build the poidata table
-        poidata = pandas.DataFrame()
-        poidata['poiid'] = range(startpoiid, startpoiid + len(poicoord))
-        poidata['type'] = self.next_category
-        poidata['ccode'] = ccode
-        poidata.to_sql(name='poidata', con=self.conn, if_exists='append', index=False)
+        batch_size = config.getint('General', 'BatchSize', fallback=utils.BATCH_SIZE)
+
+        # The source is read and inserted one batch at a time, the poiids continue across batches
+        with tracing.span('insert') as span, bulkload.transaction(self.conn):
+            for df in utils.read_geo(source, batch_size):
+                poiids = range(startpoiid, startpoiid + len(df))
+                startpoiid += len(df)
+                lon = df['lon'].tolist()
+                lat = df['lat'].tolist()
+
+                # Build the poicoord table
+                bulkload.insert(self.conn, 'poicoord', ['poiid', 'lonmin', 'lonmax', 'latmin', 'latmax'],
+                                zip(poiids, lon, lon, lat, lat))
+
+                # Build the poiname table
+                # Explicitly specify the rowid..
+                bulkload.insert(self.conn, 'poiname', ['rowid', 'name'], zip(poiids, df['name'].tolist()))
+
+                # Build the poidata table
+                bulkload.insert(self.conn, 'poidata', ['poiid', 'type', 'ccode'],
+                                ((poiid, self.next_category, ccode) for poiid in poiids))
+                span.rows(len(df))
 
         self.next_category += 1
@@ -1,12 +1,15 @@
 from __future__ import print_function
 
+import itertools
 import os
-import sqlite3
-import pandas
+import bulkload
+import optimize
+import tracing
 import utils
 import shutil
-from morton import encode_morton_code, decode_morton_code
-from PIL import Image
+import pandas
+from assets import AssetCache
+from morton import encode_morton_codes
 
 from version import VERSION
 
@@ -27,14 +30,17 @@ MIB2TSD sqlite database format:
 
 class MIB2TSD(object):
 
-    def __init__(self,dest):
+    def __init__(self,dest,assets=None,title=None):
         self.dest = dest
+        # The package title is only shown by MIB2HIGH, MIB2TSD keeps its MyPOI name
+        self.title = title
+        self.assets = assets if assets is not None else AssetCache()
         self.db = os.path.join(dest,'personalpoi','ppoidb','1','default','poidata.db3')
 
     def open(self):
         utils.create_update_dot_txt(os.path.join(self.dest,'personalpoi','InfoFile','1','default','Update.txt'),name='MyPOI (%s,%s)' % (VERSION,self.__class__.__name__))
 
-        self.conn = sqlite3.connect(self.db)
+        self.conn = bulkload.connect(self.db)
 
         cursor = self.conn.cursor()
 
@@ -52,10 +58,16 @@ class MIB2TSD(object):
         if lastrowid is None:
             cursor.execute('insert into infoDB values(?,?,?,?,?,?)',('Personal POI','1.1.1','1.0','Personal POI',0,0))
 
-        self.conn.commit()
-
     def close(self):
-        self.conn.close()
+        bulkload.close(self.conn)
+
+    def optimize(self,page_size=optimize.PAGE_SIZE):
+        ''' Rewrite the closed database in Morton order within each category, see optimize.py '''
+        conn=bulkload.connect(self.db)
+        df=pandas.read_sql_query('select pPoiId, catId, mortonCode from "pPoiAddressTable"',conn)
+        bulkload.close(conn)
+        ids=optimize.spatial_order(df['pPoiId'],df['catId'],df['mortonCode'])
+        optimize.rewrite(self.db,ids,{'pPoiAddressTable':'pPoiId','pPoiSystemTable':'pPoiId','pPoiFtsTable':'pPoiId'},page_size)
 
     def read(self,config,section):
         name=config.get(section,'Name')
@@ -76,57 +88,44 @@ class MIB2TSD(object):
         src_icon=icon
         (_,icon_extension) = os.path.splitext(src_icon)
         dst_icon='%03d_image.png' % (catid - 2001)
-        # Convert the image to a 39x39 png image (we have not tested whether any other sizes/formats are supported)
-        icon_str = f'bitmaps/{dst_icon},0,0,39,39,-19,-39'
-        img=Image.open(src_icon)
-        if any(i > 39 for i in img.size):
-            img.thumbnail((39, 39), Image.LANCZOS)
-        img=img.convert('RGBA') # Amundsen doesn't seem to like Colormap pngs
-        img.save(os.path.join(self.dest,'personalpoi','ppoidb','1','default','icon',dst_icon))
-
-        cursor.execute('insert into pPoiCategoryTable(catId,categoryDefaultName,warning) values(?,?,?)',(catid,categoryname,categorywarn))
-        cursor.execute('insert into pPoiIconTable(catId,iconSet,iconName) values(?,?,?)',(catid,1,dst_icon)) # TODO What is iconSet used for?
-        cursor.execute('insert into pPoiIconTable(catId,iconSet,iconName) values(?,?,?)',(catid,2,dst_icon))
-        self.conn.commit()
-
-
-        # Get the last rowid used in the table
-        cursor.execute('select max(rowid) from "pPoiAddressTable"')
-        (lastrowid,)=cursor.fetchone()
-        if lastrowid is None:
-            startpoiid=1
-        else:
-            startpoiid=lastrowid+1
-
-        df = utils.read_geo(source)
-
-        if (len(df) == 0):
-            return
-
-        df['mortonCode']=df.apply(lambda x: encode_morton_code(x['lat'],x['lon']),axis=1)
-
-        # Build the poiaddr table
-        poiaddr=pandas.DataFrame()
-        poiaddr['pPoiId']=range(startpoiid,startpoiid+len(df))
-        poiaddr['catId']=catid
-        poiaddr['mortonCode']=df['mortonCode']
-        poiaddr['name']=df['name']
-        poiaddr.to_sql(name='pPoiAddressTable',con=self.conn,if_exists='append',index=False)
-
-        # Build the poisystem table
-        poisystem=pandas.DataFrame()
-        poisystem['pPoiId']=range(startpoiid,startpoiid+len(poiaddr))
-        poisystem['catId']=catid
-        if 'comment' in df:
-            # Store the comment in the 'personalComment' field.
-            # TODO Check if this is displayed on the SatNav
-            poisystem['personalComment']=df['comment']
-        poisystem.to_sql(name='pPoiSystemTable',con=self.conn,if_exists='append',index=False)
-
-        # Build the poifts table
-        # 6746|[Hockley Heath] M42 [Hockley Heath]
-        poifts=pandas.DataFrame()
-        poifts['pPoiId']=range(startpoiid,startpoiid+len(poiaddr))
-        poifts['name']=df['name']
-        poifts.to_sql(name='pPoiFtsTable',con=self.conn,if_exists='append',index=False)
-
+        # Convert the image to a 39x39 png image, RGBA as Amundsen doesn't seem to like Colormap pngs
+        self.assets.icon(src_icon,os.path.join(self.dest,'personalpoi','ppoidb','1','default','icon',dst_icon),rgba=True)
+
+        batch_size=config.getint('General','BatchSize',fallback=utils.BATCH_SIZE)
+
+        with tracing.span('insert') as span, bulkload.transaction(self.conn):
+            cursor.execute('insert into pPoiCategoryTable(catId,categoryDefaultName,warning) values(?,?,?)',(catid,categoryname,categorywarn))
+            cursor.execute('insert into pPoiIconTable(catId,iconSet,iconName) values(?,?,?)',(catid,1,dst_icon)) # TODO What is iconSet used for?
+            cursor.execute('insert into pPoiIconTable(catId,iconSet,iconName) values(?,?,?)',(catid,2,dst_icon))
+
+            # Get the last rowid used in the table
+            cursor.execute('select max(rowid) from "pPoiAddressTable"')
+            (lastrowid,)=cursor.fetchone()
+            if lastrowid is None:
+                startpoiid=1
+            else:
+                startpoiid=lastrowid+1
+
+            # The source is read and inserted one batch at a time, the poiids continue across batches
+            for df in utils.read_geo(source,batch_size):
+                with tracing.span('morton',rows=len(df)):
+                    mortoncodes=encode_morton_codes(df['lat'].to_numpy(),df['lon'].to_numpy()).astype('int64').tolist()
+                poiids=range(startpoiid,startpoiid+len(df))
+                startpoiid+=len(df)
+                names=df['name'].tolist()
+
+                # Build the poiaddr table
+                bulkload.insert(self.conn,'pPoiAddressTable',['pPoiId','catId','mortonCode','name'],zip(poiids,itertools.repeat(catid),mortoncodes,names))
+
+                # Build the poisystem table
+                if 'comment' in df:
+                    # Store the comment in the 'personalComment' field.
+                    # TODO Check if this is displayed on the SatNav
+                    bulkload.insert(self.conn,'pPoiSystemTable',['pPoiId','catId','personalComment'],zip(poiids,itertools.repeat(catid),df['comment'].tolist()))
+                else:
+                    bulkload.insert(self.conn,'pPoiSystemTable',['pPoiId','catId'],zip(poiids,itertools.repeat(catid)))
+
+                # Build the poifts table
+                # 6746|[Hockley Heath] M42 [Hockley Heath]
+                bulkload.insert(self.conn,'pPoiFtsTable',['pPoiId','name'],zip(poiids,names))
+                span.rows(len(df))
@@ -85,6 +85,74 @@ def decode_morton_code(code):
     lng-=360
   return (lat,lng)
 
+#
+# Batch versions of the above working on numpy arrays, these give bit-identical results
+#
+
+import numpy
+
+def widen_array(v):
+  ''' widen() for a uint64 numpy array '''
+  v = v | (v << 16)
+  v &= 0x0000ffff0000ffff
+  v |= v << 8
+  v &= 0x00ff00ff00ff00ff
+  v |= v << 4
+  v &= 0x0f0f0f0f0f0f0f0f
+  v |= v << 2
+  v &= 0x3333333333333333
+  v |= v << 1
+  v &= 0x5555555555555555
+  return v
+
+def unwiden_array(v):
+  ''' unwiden() for a uint64 numpy array '''
+  v = v & 0x5555555555555555
+  v ^= v>>1
+  v &= 0x3333333333333333
+  v ^= v>>2
+  v &= 0x0f0f0f0f0f0f0f0f
+  v ^= v>>4
+  v &= 0x00ff00ff00ff00ff
+  v ^= v>>8
+  v &= 0x0000ffff0000ffff
+  v ^= v>>16
+  v &= 0x00000000ffffffff
+  return v
+
+def encode_morton_codes(lat,lng):
+  ''' encode_morton_code() for arrays of latitudes and longitudes, returns a uint64 array '''
+  lat = numpy.asarray(lat,dtype=numpy.float64)
+  lng = numpy.asarray(lng,dtype=numpy.float64)
+  invalid = ~((lat>=-90.0) & (lat<=90.0) & (lng>=-180.0) & (lng<=180.0))
+  if invalid.any():
+    i = numpy.argmax(invalid)
+    raise Exception("Invalid longitude/latitude %f %f" % (lng.flat[i],lat.flat[i]))
+  lat = numpy.where(lat<0,lat+180,lat)
+  lng = numpy.where(lng<0,lng+360,lng)
+  latw = (lat*0xffffffff/360.0).astype(numpy.uint64)
+  lngw = (lng*0xffffffff/360.0).astype(numpy.uint64)
+  latw = widen_array(latw)
+  lngw = widen_array(lngw)
+  return lngw | ( latw << 1 )
+
+def decode_morton_codes(codes):
+  ''' decode_morton_code() for an array of morton codes, returns arrays (lat,lng) '''
+  codes = numpy.asarray(codes)
+  if not numpy.issubdtype(codes.dtype,numpy.integer):
+    raise Exception("Invalid morton code dtype %s" % (codes.dtype))
+  invalid = codes<0 if numpy.issubdtype(codes.dtype,numpy.signedinteger) else codes>2**63-1
+  if invalid.any():
+    raise Exception("Invalid morton code %d" % (codes.flat[numpy.argmax(invalid)]))
+  codes = codes.astype(numpy.uint64)
+  lat = unwiden_array(codes>>1).astype(numpy.float64)
+  lng = unwiden_array(codes).astype(numpy.float64)
+  lat *= 360.0/0xffffffff
+  lng *= 360.0/0xffffffff
+  lat = numpy.where(lat>=90,lat-180,lat)
+  lng = numpy.where(lng>=180,lng-360,lng)
+  return (lat,lng)
+
 #
 # Test Code
 #
@@ -110,6 +178,38 @@ def test_morton_codes():
       
       print("lat %f lng %f morton %d (0x%x) : %d (0x%x) (%f,%f) (%f,%f)" % (lat,lng,morton,morton,m1,m1,lat1,lng1,lat2,lng2))
 
+    # The batch versions must match the scalar versions bit for bit
+    lat = numpy.array([ x[0] for x in morton_test_data ] + list(numpy.random.uniform(-90,90,10000)))
+    lng = numpy.array([ x[1] for x in morton_test_data ] + list(numpy.random.uniform(-180,180,10000)))
+    codes = encode_morton_codes(lat,lng)
+    assert all(int(c)==encode_morton_code(la,ln) for (c,la,ln) in zip(codes,lat,lng))
+    (lat1,lng1) = decode_morton_codes(codes)
+    assert all((la,ln)==decode_morton_code(int(c)) for (c,la,ln) in zip(codes,lat1,lng1))
+    (lat2,lng2) = decode_morton_codes(numpy.array([ x[2] for x in morton_test_data ],dtype=numpy.int64))
+    assert all((la,ln)==decode_morton_code(x[2]) for (x,la,ln) in zip(morton_test_data,lat2,lng2))
+    print("batch encode/decode matches scalar for %d coordinates" % len(codes))
+
+def benchmark_morton_codes(n=1000000):
+  ''' Compare throughput of the scalar and batch encoders '''
+  import time
+  lat = numpy.random.uniform(-90,90,n)
+  lng = numpy.random.uniform(-180,180,n)
+
+  t = time.perf_counter()
+  for i in range(min(n,100000)):
+    encode_morton_code(lat[i],lng[i])
+  scalar = min(n,100000)/(time.perf_counter()-t)
+
+  t = time.perf_counter()
+  codes = encode_morton_codes(lat,lng)
+  batch = n/(time.perf_counter()-t)
+
+  t = time.perf_counter()
+  decode_morton_codes(codes)
+  batch_decode = n/(time.perf_counter()-t)
+
+  print("encode: scalar %.0f/s, batch %.0f/s (%.0fx); batch decode %.0f/s" % (scalar,batch,batch/scalar,batch_decode))
+
 
 def build_test_csv():
   ''' build a csv for testing: longitude, latitude, name '''
@@ -119,7 +219,6 @@ def build_test_csv():
 
 import sqlite3
 import pandas
-import numpy
 
 def latitude_isclose(l1,l2):
   # WARNING WARNING WARNING Dodgy hack..
@@ -181,4 +280,5 @@ if __name__ == "__main__":
   #build_test_csv()
   regression_test("testdata_poidata.db3") # test database created using Skoda Destinations site, with csv generated from build_test_csv()
   test_morton_codes()
+  benchmark_morton_codes()
 
@@ -3,10 +3,17 @@ import contextlib
 import os
 import shutil
 import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
 import mib2high as m2high
 import mib2tsd as m2tsd
+import optimize
 import poifix
+import spatial
+import tracing
+import utils
+from assets import AssetCache
 from version import VERSION
 
 
@@ -20,20 +27,102 @@ def resource_path(rpath):
     return os.path.join(bpath, rpath)
 
 
-def create_mypois(config_file):
+def read_config(config_file):
     config = configparser.ConfigParser()
     config.optionxform = str  # make case sensitive
 
     config.read_file(open(config_file))
+    return config
+
+
+def share_sources(config, sections, tmp):
+    """ Parse every source once. Sources that are not already POI bundles are
+        converted into bundles in tmp, which the writers then memory-map.
+    """
+
+    sources = {}
+    for section in sections:
+        source = config.get(section, 'Source')
+        if os.path.splitext(source)[1].lower() != '.poi':
+            with tracing.span('share_source', section=section) as span:
+                df = utils.read_geo(source)
+                shared = os.path.join(tmp, f'{section}.poi')
+                utils.write_geo_poi(shared, df['lon'], df['lat'], df['name'], df['comment'] if 'comment' in df else None)
+                span.rows(len(df))
+            source = shared
+        sources[section] = source
+    return sources
+
+
+def apply_budget(config, sources, tmp):
+    """ Thin the sources to [General] MaxPOIs POIs in total. Categories are served in
+        Priority order, so the least important ones lose POIs, from their densest cells
+        first (see spatial.thin). Thinned sources are written to tmp.
+    """
+
+    limit = config.getint('General', 'MaxPOIs', fallback=0)
+    if not limit:
+        return sources
+    remaining = limit
+    budgeted = dict(sources)
+    for section in sorted(sources, key=lambda section: config.getint(section, 'Priority', fallback=0)):
+        df = utils.read_geo(sources[section])
+        (total, keep) = (len(df), min(len(df), remaining))
+        remaining -= keep
+        if keep == total:
+            continue
+        with tracing.span('budget', section=section, rows=keep):
+            df = df[spatial.thin(df['lon'].to_numpy(), df['lat'].to_numpy(), keep, config.getfloat(section, 'ThinCell', fallback=10000))]
+            budgeted[section] = os.path.join(tmp, f'{section}.budget.poi')
+            utils.write_geo_poi(budgeted[section], df['lon'], df['lat'], df['name'], df['comment'] if 'comment' in df else None)
+        print(f'{section}: MaxPOIs budget kept {keep} of {total} POIs')
+    return budgeted
+
+
+def build(target, dest, config_file, sources, fix=True, title=None):
+    """ Build the database of one target from the shared sources """
+
+    with tracing.span('build', stage=True, target=target.__name__):
+        config = read_config(config_file)
+        # Icons and xml files are shared between targets and builds through the asset cache
+        cache = config.get('General', 'CacheDirectory', fallback='cache')
+        writer = target(dest, AssetCache(os.path.join(cache, 'assets')), title)
+        with tracing.span('open'):
+            writer.open()
+        for section, source in sources.items():
+            config[section]['Source'] = source
+            with tracing.span('load', section=section):
+                writer.read(config, section)
+        with tracing.span('close'):
+            writer.close()
+        if config.getboolean('General', 'Optimize', fallback=True):
+            with tracing.span('optimize'):
+                writer.optimize(config.getint('General', 'PageSize', fallback=optimize.PAGE_SIZE))
+        if not fix:
+            return
+
+        # Remember file checksums between builds so unchanged files are not hashed again
+        os.makedirs(cache, exist_ok=True)
+        poifix.fix(writer.dest, os.path.join(cache, f'poifix_{target.__name__}.json'))
+
+
+def create_mypois(config_file, fix=True, dest=None, sources=None, title=None):
+    """ Build the enabled targets and return their directories. With fix=False the
+        sizes and checksums are left to the caller, e.g. package.write_package.
+        dest overrides OutputDirectory and sources the Source of the given sections,
+        so several regions can be built from one config; title names the package.
+    """
+
+    config = read_config(config_file)
+    for section, source in (sources or {}).items():
+        if section in config:
+            config[section]['Source'] = source
 
-    dest = None
-    mib2high = None
-    mib2tsd = None
     skipmib2std = False
     skipmib2high = False
 
     if 'General' in config:
-        if 'OutputDirectory' in config['General']:
+        if dest is None and 'OutputDirectory' in config['General']:
             dest = config['General']['OutputDirectory']
         skipmib2std = config.getboolean('General', 'SkipMIB2STD', fallback=False)
         skipmib2high = config.getboolean('General', 'SkipMIB2HIGH', fallback=False)
@@ -46,32 +135,32 @@ def create_mypois(config_file):
             shutil.rmtree(dest)
     shutil.copytree(resource_path('template'), dest)
 
+    targets = []
     if not skipmib2high:
-        mib2high = m2high.MIB2HIGH(os.path.join(dest, 'PersonalPOI', 'MIB2', 'MIB2HIGH'))
-        mib2high.open()
-
+        targets.append((m2high.MIB2HIGH, os.path.join(dest, 'PersonalPOI', 'MIB2', 'MIB2HIGH')))
     if not skipmib2std:
-        mib2tsd = m2tsd.MIB2TSD(os.path.join(dest, 'PersonalPOI', 'MIB2TSD'))
-        mib2tsd.open()
+        targets.append((m2tsd.MIB2TSD, os.path.join(dest, 'PersonalPOI', 'MIB2TSD')))
 
+    sections = []
     for section in config.sections():
         if section != 'General':
             if 'Disabled' in config[section] and config.getboolean(section, 'Disabled'):
                 print("Disabled")
                 continue
+            sections.append(section)
 
-            if not skipmib2high:
-                mib2high.read(config, section)
-            if not skipmib2std:
-                mib2tsd.read(config, section)
+    with tempfile.TemporaryDirectory() as tmp:
+        sources = apply_budget(config, share_sources(config, sections, tmp), tmp)
 
-    if not skipmib2high:
-        mib2high.close()
-        poifix.fix(mib2high.dest)
+        if len(targets) == 1:
+            build(*targets[0], config_file, sources, fix, title)
+        elif targets:
+            # Both databases are independent, so build them concurrently
+            with ProcessPoolExecutor(max_workers=len(targets)) as executor:
+                for future in [executor.submit(build, *target, config_file, sources, fix, title) for target in targets]:
+                    future.result()
 
-    if not skipmib2std:
-        mib2tsd.close()
-        poifix.fix(mib2tsd.dest)
+    return [target_dest for (target, target_dest) in targets]
 
 
 def main():
@@ -0,0 +1,79 @@
+import contextlib
+import os
+import re
+
+import numpy
+
+import bulkload
+
+'''
+Post-build rewrite of a poidata database into spatial order.
+
+The writers append the POIs category by category in source order, so neighbouring
+POIs end up on unrelated pages of every table, and the rtree and FTS indexes are
+built from randomly ordered inserts. rewrite() copies a finished database into a
+fresh file with the POI ids renumbered in the given order, which spatial_order()
+makes Morton order within each category: ids stay contiguous per category, while
+the rows, rtree nodes and FTS doclists of nearby POIs share pages. The copy is
+written with the chosen page size, its FTS indexes are merged into one segment,
+ANALYZE records the table statistics and a final VACUUM leaves no free pages.
+'''
+
+# Page size of the rewritten databases
+PAGE_SIZE = 4096
+
+
+def spatial_order(ids, categories, morton):
+    ''' ids sorted by category, then Morton code '''
+    return numpy.asarray(ids)[numpy.lexsort((numpy.asarray(morton), numpy.asarray(categories)))]
+
+
+def rewrite(db, ids, tables, page_size=PAGE_SIZE):
+    ''' Rewrite db with the POI ids renumbered in the order of ids, keeping its lowest id.
+        tables maps each table holding POIs to its POI id column (or rowid), the rows
+        of the other tables are copied as they are.
+    '''
+    tmp = f'{db}.tmp'
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(tmp)
+    conn = bulkload.connect(tmp)
+    # Only takes effect as the file is still empty
+    conn.execute(f'pragma page_size={int(page_size)}')
+    conn.execute('attach database ? as src', (db,))
+
+    schema = conn.execute("select type, name, sql from src.sqlite_master where sql is not null and name not like 'sqlite_%' order by rowid").fetchall()
+    virtual = [name for (type_, name, sql) in schema if re.match(r'\s*create\s+virtual\s+table', sql, re.I)]
+    # The rtree and FTS tables create their own shadow tables
+    content = [(name, sql) for (type_, name, sql) in schema
+               if type_ == 'table' and not any(name.startswith(f'{table}_') for table in virtual)]
+
+    first = int(numpy.min(ids)) if len(ids) else 0
+    with bulkload.transaction(conn):
+        conn.execute('create temp table "remap" (old INTEGER PRIMARY KEY, new INTEGER)')
+        bulkload.insert(conn, 'remap', ['old', 'new'], zip(numpy.asarray(ids).tolist(), range(first, first + len(ids))))
+
+        for (name, sql) in content:
+            conn.execute(sql)
+            columns = [row[1] for row in conn.execute(f'pragma src.table_info("{name}")')]
+            if name in tables:
+                key = tables[name]
+                if key not in columns:
+                    columns.insert(0, key)
+                values = ','.join('r.new' if column == key else f't.{column}' for column in columns)
+                conn.execute(f'insert into main."{name}" ({",".join(columns)}) select {values} from src."{name}" t '
+                             f'join temp."remap" r on r.old = t.{key} order by r.new')
+            else:
+                conn.execute(f'insert into main."{name}" ({",".join(columns)}) select {",".join(columns)} from src."{name}" order by rowid')
+            if re.search(r'using\s+fts[34]', sql, re.I):
+                conn.execute(f'insert into main."{name}"("{name}") values(\'optimize\')')
+
+        for (type_, name, sql) in schema:
+            if type_ in ('index', 'trigger', 'view'):
+                conn.execute(sql)
+
+    conn.execute('drop table temp."remap"')
+    conn.execute('detach database src')
+    conn.execute('analyze')
+    conn.execute('vacuum')
+    bulkload.close(conn)
+    os.replace(tmp, db)
@@ -0,0 +1,263 @@
+import asyncio
+import contextlib
+import email.utils
+import random
+import re
+import time
+import zlib
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+import cache
+import events
+import tracing
+from elements import Elements, IncompleteResponse, parse
+from version import VERSION
+
+'''
+Overpass API access: query building, the response cache, an HTTP client and an
+asyncio fetch engine that runs many area queries from a single event loop.
+'''
+
+overpass_url = 'https://overpass-api.de/api/interpreter'
+
+response_cache = None
+client = None
+
+
+def configure_cache(directory, ttl, max_size, offline):
+    global response_cache
+    response_cache = cache.ResponseCache(directory, ttl=ttl, max_size=max_size, offline=offline)
+
+
+def area_query(relationid, statements):
+    return f'{overpass_url}?data=[out:json][timeout:300];area(id:{3600000000+relationid})->.searchArea;{statements}'
+
+
+def bbox_query(tile, statements):
+    ''' Run statements written against .searchArea on the bounding box of tile instead '''
+    return f'{overpass_url}?data=[out:json][timeout:300];{statements.replace("(area.searchArea)", f"({tile.bbox()})")}'
+
+
+def union(statements):
+    ''' Several categories in one query. Each category's output is preceded by a derived
+        "category" marker element so the response can be split locally.
+    '''
+    return ''.join(f'make category name="{name}";out;{statement}' for name, statement in statements.items())
+
+
+def union_query(area, statements):
+    ''' One query for several categories of an area: a country's relation id or a tiles.Tile '''
+    if isinstance(area, int):
+        return area_query(area, union(statements))
+    return bbox_query(area, union(statements))
+
+
+def changed_statement(statement, since):
+    ''' Restrict a category statement (a query followed by its output) to elements
+        modified after the OSM timestamp since.
+    '''
+    query, output = statement.split(';', 1)
+    return f'{query}(newer:"{since}");{output}'
+
+
+def ids_statement(statement):
+    ''' List only the type and id of every element a category statement matches '''
+    return f'{statement.split(";", 1)[0]};out ids;'
+
+
+class QueryError(Exception):
+    ''' A request Overpass rejects for good, e.g. a syntax error (400) '''
+    pass
+
+
+def retry_after(response):
+    ''' Seconds to wait according to a Retry-After header (seconds or HTTP date), or None '''
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return int(value)
+    with contextlib.suppress(TypeError, ValueError):
+        return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    return None
+
+
+def slot_wait(text):
+    ''' Seconds until a query slot is free according to an /api/status page, or None '''
+    if re.search(r'^\d+ slots? available now', text, re.MULTILINE):
+        return 0
+    waits = [int(seconds) for seconds in re.findall(r'^Slot available after: .*, in (-?\d+) seconds', text, re.MULTILINE)]
+    return max(0, min(waits)) if waits else None
+
+
+class Client(object):
+    ''' Overpass HTTP client: one keep-alive connection pool shared by the fetch threads,
+        connect and read timeouts, gzip transfer and status-aware retries. 429 and 503/504
+        wait for Retry-After, the next free slot of /api/status or an exponential backoff
+        with jitter; other 5xx responses and network errors, also while the body is
+        read, back off; 400 and the other 4xx are query errors and raised at once.
+    '''
+
+    TRANSIENT = (429, 500, 502, 503, 504)
+    # Network errors of requests, and of urllib3 for bodies read from response.raw
+    NETWORK_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                      urllib3.exceptions.HTTPError)
+
+    def __init__(self, pool_size=4, connect_timeout=10, read_timeout=330, attempts=6, backoff=2, max_wait=300):
+        self.timeout = (connect_timeout, read_timeout)
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_wait = max_wait
+        self.session = requests.Session()
+        self.session.headers.update({'Accept-Encoding': 'gzip', 'User-Agent': f'osm-poi/{VERSION}'})
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def status(self, url):
+        ''' Seconds until the endpoint of url has a free slot, or None if it does not say '''
+        parts = urlsplit(url)
+        status_url = urlunsplit((parts.scheme, parts.netloc, parts.path.rsplit('/', 1)[0] + '/status', '', ''))
+        try:
+            with self.session.get(status_url, timeout=self.timeout[0]) as response:
+                return slot_wait(response.text) if response.status_code == 200 else None
+        except requests.RequestException:
+            return None
+
+    def delay(self, attempt, url, response=None):
+        delay = self.backoff * 2 ** attempt * random.uniform(.5, 1)
+        if response is not None and response.status_code in (429, 503, 504):
+            advised = retry_after(response)
+            if advised is None:
+                advised = self.status(url)
+            if advised is not None:
+                delay = advised + random.uniform(0, 1)
+        return min(delay, self.max_wait)
+
+    def get(self, url, read):
+        ''' Open a streamed 200 response for url and return read(response), retrying
+            transient failures of the request and of reading its body
+        '''
+        for attempt in range(self.attempts):
+            last = attempt == self.attempts - 1
+            try:
+                response = self.session.get(url, stream=True, timeout=self.timeout)
+                if response.status_code == 200:
+                    response.raw.decode_content = True
+                    with response:
+                        return read(response)
+            except self.NETWORK_ERRORS as e:
+                if last:
+                    raise
+                delay = self.delay(attempt, url)
+                events.emit('retry', error=e.__class__.__name__)
+                print(f'{e.__class__.__name__}, retrying in {delay:.0f}s: {url}')
+                time.sleep(delay)
+                continue
+
+            with response:
+                # Read the error page, so the connection goes back to the pool
+                response.content
+                if response.status_code not in self.TRANSIENT:
+                    raise QueryError(f'HTTP {response.status_code}: {response.text[:1000]}')
+                if last:
+                    response.raise_for_status()
+                delay = self.delay(attempt, url, response)
+            events.emit('retry', error=response.status_code)
+            print(f'HTTP {response.status_code}, retrying in {delay:.0f}s: {url}')
+            time.sleep(delay)
+
+
+def configure_client(pool_size=4, connect_timeout=10, read_timeout=330, attempts=6):
+    global client
+    client = Client(pool_size, connect_timeout, read_timeout, attempts)
+
+
+def download(url, read):
+    ''' read(response) of the response to url, read again from the start on a retry '''
+    global client
+    print(url)
+    if client is None:
+        configure_client()
+    return client.get(url, read)
+
+
+def get_data(url, tags, cached=True):
+    ''' Fetch a union query and stream it into one Elements store per category.
+        tags maps each category in the query to the tag keys it keeps. With cached=False
+        the response cache is bypassed, for queries whose answer must be current.
+    '''
+    def stores():
+        return {name: Elements(keys) for name, keys in tags.items()}
+
+    def parse_response(response):
+        # A retry parses into new stores
+        result = parse(response.raw, stores())
+        events.emit('request', bytes=response.raw.tell(), cached=False)
+        return result
+
+    def parse_cached(f):
+        # Neither an aborted query nor a truncated or corrupt entry may be served again
+        try:
+            with tracing.span('parse'), f:
+                return parse(f, stores())
+        except (IncompleteResponse, ValueError, EOFError, OSError, zlib.error):
+            response_cache.discard(url)
+            raise
+
+    def store_response(response):
+        # A retry starts over, without what an earlier attempt stored
+        response_cache.discard(url)
+        f = response_cache.put_stream(url, response.iter_content(1 << 20))
+        events.emit('request', bytes=response.raw.tell(), cached=False)
+        return parse_cached(f)
+
+    with tracing.span('get_data', categories=','.join(tags)) as span:
+        if response_cache is None or not cached:
+            with tracing.span('download_parse'):
+                result = download(url, parse_response)
+        else:
+            f = response_cache.open(url)
+            span.set(cached=f is not None)
+            if f is None:
+                if response_cache.offline:
+                    raise cache.CacheMiss(url)
+                with tracing.span('download'):
+                    result = download(url, store_response)
+            else:
+                events.emit('request', bytes=0, cached=True)
+                result = parse_cached(f)
+        span.rows(sum(len(elements) for elements in result.values()))
+    return result
+
+
+async def fetch_all(jobs, concurrency=4):
+    ''' Fetch (key, url, tags[, cached]) jobs from one event loop with at most `concurrency`
+        requests in flight per endpoint. Yields (key, stores) in completion order, or
+        (key, error) for a query Overpass aborted (IncompleteResponse). The caller may
+        append jobs to the list while iterating, e.g. to split an aborted query.
+    '''
+    semaphores = {}
+
+    async def fetch(key, url, tags, cached=True):
+        semaphore = semaphores.setdefault(urlsplit(url).netloc, asyncio.Semaphore(concurrency))
+        async with semaphore:
+            try:
+                return key, await asyncio.to_thread(get_data, url, tags, cached)
+            except IncompleteResponse as e:
+                return key, e
+
+    pending = set()
+    started = 0
+    while True:
+        pending.update(asyncio.ensure_future(fetch(*job)) for job in jobs[started:])
+        started = len(jobs)
+        if not pending:
+            return
+        (done, pending) = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            yield task.result()
@@ -0,0 +1,220 @@
+import collections
+import contextlib
+import hashlib
+import os
+import stat
+import struct
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import poifix
+import tracing
+
+'''
+Streaming writer for the release zip.
+
+Every file of the output directory is read once in fixed size blocks. The reading
+thread keeps the CRC-32 and any whole-file SHA1 poifix needs, while a thread pool
+deflates the blocks and computes the per-block SHA1 digests of hashes.txt. Each block
+is compressed into an independent raw deflate stream ending on a byte boundary
+(sync flush, the last block of a file is finished), so the compressed blocks can be
+concatenated in order into one entry, as pigz does.
+
+The sizes and checksums are handed to poifix, which then fixes metainfo2.txt and
+writes hashes.txt without reading the files again; those two are added to the
+archive last.
+'''
+
+BLOCK_SIZE = 1 << 20
+ZIP64_LIMIT = 0xFFFFFFFF
+
+assert BLOCK_SIZE % poifix.checkSumSize == 0
+
+
+def deflate_block(data, last, checksum_size=0):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    digests = [hashlib.sha1(data[i:i + checksum_size]).hexdigest() for i in range(0, len(data), checksum_size)] if checksum_size else []
+    return compressed, digests
+
+
+def dos_time(timestamp):
+    (year, month, day, hour, minute, second) = time.localtime(timestamp)[:6]
+    if year < 1980:
+        (year, month, day, hour, minute, second) = (1980, 1, 1, 0, 0, 0)
+    return (hour << 11 | minute << 5 | second // 2), ((year - 1980) << 9 | month << 5 | day)
+
+
+class ZipWriter(object):
+    ''' Minimal zip writer for entries whose deflate data is produced elsewhere.
+        Local headers are written with zero sizes and patched once the entry is complete.
+    '''
+
+    def __init__(self, f):
+        self.f = f
+        self.entries = []
+
+    def begin(self, name, st):
+        is_dir = stat.S_ISDIR(st.st_mode)
+        name = name + '/' if is_dir else name
+        encoded = name.encode('utf-8')
+        entry = {
+            'name': encoded,
+            'flags': 0 if name.isascii() else 0x800,
+            'method': zipfile.ZIP_STORED if is_dir else zipfile.ZIP_DEFLATED,
+            'time': dos_time(st.st_mtime),
+            'attr': (st.st_mode & 0xFFFF) << 16 | (0x10 if is_dir else 0),
+            'offset': self.f.tell(),
+            'crc': 0,
+            'csize': 0,
+            'size': 0,
+        }
+        self.f.write(self.local_header(entry))
+        self.entries.append(entry)
+        return entry
+
+    def local_header(self, entry):
+        return struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, entry['flags'], entry['method'], *entry['time'],
+                           entry['crc'], entry['csize'], entry['size'], len(entry['name']), 0) + entry['name']
+
+    def write(self, entry, data):
+        self.f.write(data)
+        entry['csize'] += len(data)
+
+    def end(self, entry, crc, size):
+        entry['crc'] = crc
+        entry['size'] = size
+        if max(entry['csize'], size, entry['offset']) >= ZIP64_LIMIT:
+            raise zipfile.LargeZipFile(f'{entry["name"].decode()} would require ZIP64 extensions')
+        position = self.f.tell()
+        self.f.seek(entry['offset'])
+        self.f.write(self.local_header(entry))
+        self.f.seek(position)
+
+    def close(self):
+        start = self.f.tell()
+        for entry in self.entries:
+            self.f.write(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 3 << 8 | 20, 20, entry['flags'], entry['method'], *entry['time'],
+                                     entry['crc'], entry['csize'], entry['size'], len(entry['name']), 0, 0, 0, 0,
+                                     entry['attr'], entry['offset']) + entry['name'])
+        end = self.f.tell()
+        if len(self.entries) >= 0xFFFF or end >= ZIP64_LIMIT:
+            raise zipfile.LargeZipFile('Archive would require ZIP64 extensions')
+        self.f.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(self.entries), len(self.entries), end - start, start, 0))
+
+
+class Packer(object):
+    ''' Reads files into a ZipWriter, compressing blocks on a thread pool with a bounded
+        number of blocks in flight, and seeds a poifix.Hasher with the checksums it was asked for.
+    '''
+
+    def __init__(self, writer, executor, hasher, requests, max_pending):
+        self.writer = writer
+        self.executor = executor
+        self.hasher = hasher
+        self.requests = requests
+        self.max_pending = max_pending
+        self.pending = collections.deque()
+
+    def add(self, path, name):
+        st = os.stat(path)
+        job = {'path': path, 'name': name, 'stat': st, 'entry': None, 'digests': [], 'crc': 0, 'size': 0, 'chunked': 0, 'whole': None}
+        if stat.S_ISDIR(st.st_mode):
+            self.pending.append((job, True, None))
+            return
+
+        sizes = self.requests.get(os.path.abspath(path), ())
+        job['chunked'] = poifix.checkSumSize if poifix.checkSumSize in sizes else 0
+        job['whole'] = hashlib.sha1() if 0 in sizes else None
+
+        with open(path, 'rb') as f:
+            block = f.read(BLOCK_SIZE)
+            while True:
+                following = f.read(BLOCK_SIZE) if len(block) == BLOCK_SIZE else b''
+                last = not following
+                job['crc'] = zlib.crc32(block, job['crc'])
+                job['size'] += len(block)
+                if job['whole'] is not None:
+                    job['whole'].update(block)
+                self.pending.append((job, last, self.executor.submit(deflate_block, block, last, job['chunked'])))
+                self.drain(self.max_pending)
+                if last:
+                    break
+                block = following
+
+    def drain(self, limit=0):
+        # Entries are written in the order they were added, once their blocks are compressed
+        while len(self.pending) > limit:
+            (job, last, future) = self.pending.popleft()
+            if job['entry'] is None:
+                job['entry'] = self.writer.begin(job['name'], job['stat'])
+            if future is None:
+                continue
+            (compressed, digests) = future.result()
+            self.writer.write(job['entry'], compressed)
+            job['digests'] += digests
+            if last:
+                self.writer.end(job['entry'], job['crc'], job['size'])
+                if job['chunked']:
+                    self.hasher.seed(job['path'], job['chunked'], (job['size'], job['digests']))
+                if job['whole'] is not None:
+                    self.hasher.seed(job['path'], 0, (job['size'], job['whole'].hexdigest()))
+
+
+def write_package(source_dir, zip_path, fix=(), workers=None):
+    ''' Zip source_dir into zip_path like shutil.make_archive(root_dir=source_dir).
+        For every directory in fix, poifix is run once its files are packed; its
+        metainfo2.txt and hashes.txt files are then added from the fixed versions.
+    '''
+    workers = workers or os.cpu_count() or 1
+    tmp = zip_path + '.tmp'
+    excluded = {os.path.abspath(zip_path), os.path.abspath(tmp)}
+
+    hasher = poifix.Hasher()
+    requests = {}
+    for base in fix:
+        for (path, size) in poifix.checksum_requests(base):
+            requests.setdefault(os.path.abspath(path), set()).add(size)
+
+    bases = [os.path.abspath(base) for base in fix]
+
+    def deferred(path):
+        path = os.path.abspath(path)
+        return any(path == os.path.join(base, 'metainfo2.txt') or
+                   (os.path.basename(path) == 'hashes.txt' and path.startswith(base + os.sep)) for base in bases)
+
+    def arcname(path):
+        return os.path.relpath(path, source_dir).replace(os.sep, '/')
+
+    try:
+        with tracing.span('write_package') as span, open(tmp, 'wb') as f, ThreadPoolExecutor(max_workers=workers) as executor:
+            writer = ZipWriter(f)
+            packer = Packer(writer, executor, hasher, requests, 2 * workers)
+            for (dirpath, dirnames, filenames) in os.walk(source_dir):
+                dirnames.sort()
+                for name in dirnames:
+                    packer.add(os.path.join(dirpath, name), arcname(os.path.join(dirpath, name)))
+                for name in sorted(filenames):
+                    path = os.path.join(dirpath, name)
+                    if os.path.abspath(path) not in excluded and not deferred(path):
+                        packer.add(path, arcname(path))
+            packer.drain()
+            span.rows(len(writer.entries))
+
+            for base in fix:
+                poifix.fix(base, hasher=hasher)
+                for (dirpath, dirnames, filenames) in os.walk(base):
+                    dirnames.sort()
+                    for name in sorted(filenames):
+                        path = os.path.join(dirpath, name)
+                        if deferred(path):
+                            packer.add(path, arcname(path))
+            packer.drain()
+            writer.close()
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp)
+        raise
+    os.replace(tmp, zip_path)
@@ -0,0 +1,504 @@
+import os
+import re
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+import tracing
+from elements import Elements
+
+'''
+Reader for local OSM PBF extracts (https://wiki.openstreetmap.org/wiki/PBF_Format)
+that produces the same per-category Elements as the Overpass queries.
+
+The file is read in passes over its data blobs, each decoded on a process pool:
+
+1. every blob is decoded and the category tag filters are applied to its nodes, ways
+   and relations. The id range of every blob is remembered;
+2. ways that are members of matching relations are read, if their centers are needed;
+3. the coordinates of the nodes the matching ways and relations refer to are read.
+
+Way and relation centers are then resolved locally as the center of their bounding
+box, like "out center" does. Only the blobs whose id range contains a wanted id are
+decoded again in the later passes. Packed fields are decoded with NumPy, one
+primitive group at a time.
+'''
+
+NODE, WAY, RELATION = 0, 1, 2
+
+SELECTORS = {
+    'node': (NODE,), 'way': (WAY,), 'relation': (RELATION,),
+    'nw': (NODE, WAY), 'nr': (NODE, RELATION), 'wr': (WAY, RELATION), 'nwr': (NODE, WAY, RELATION),
+}
+
+SUPPORTED_FEATURES = {'OsmSchema-V0.6', 'DenseNodes'}
+
+# PrimitiveGroup fields
+WAY_FIELD, RELATION_FIELD = 3, 4
+
+
+class Filter(object):
+    ''' Element types, tag conditions and output mode of an Overpass category statement
+        such as nwr["amenity"="fuel"](area.searchArea);out center;
+    '''
+
+    def __init__(self, statement, tags=()):
+        query, output = statement.split(';', 1)
+        match = re.fullmatch(r'(\w+)((?:\[[^\]]*\])+)\(area\.searchArea\)', query.strip())
+        if match is None or match.group(1) not in SELECTORS:
+            raise ValueError(f'Unsupported query for PBF extracts: {query}')
+        self.types = SELECTORS[match.group(1)]
+        self.conditions = []
+        for condition in re.findall(r'\[([^\]]*)\]', match.group(2)):
+            tag = re.fullmatch(r'"([^"]+)"(?:="([^"]*)")?', condition)
+            if tag is None:
+                raise ValueError(f'Unsupported tag filter for PBF extracts: [{condition}]')
+            self.conditions.append(tag.groups())
+        # out geom returns the member positions of relations instead of centers
+        self.geom = 'out geom' in output
+        self.tags = list(tags)
+
+    def compile(self, index):
+        ''' String table ids of the conditions in a block, or None if nothing there can match '''
+        conditions = []
+        for key, value in self.conditions:
+            if key not in index or (value is not None and value not in index):
+                return None
+            conditions.append((index[key], None if value is None else index[value]))
+        return conditions
+
+
+def varint(buf, pos):
+    result = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def int64(value):
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def fields(buf):
+    ''' Iterate over (field number, value) of a protobuf message in memoryview buf.
+        Varints are returned as ints, everything else as memoryviews.
+    '''
+    pos, end = 0, len(buf)
+    while pos < end:
+        key, pos = varint(buf, pos)
+        wire = key & 7
+        if wire == 0:
+            value, pos = varint(buf, pos)
+        elif wire == 2:
+            length, pos = varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire == 1:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError(f'Unsupported protobuf wire type {wire}')
+        yield key >> 3, value
+
+
+def packed(buf):
+    ''' Decode packed varints. Returns (values as uint64, index of the last byte of each) '''
+    data = numpy.frombuffer(buf, dtype=numpy.uint8)
+    ends = numpy.flatnonzero(data < 0x80)
+    starts = numpy.empty_like(ends)
+    starts[:1] = 0
+    starts[1:] = ends[:-1] + 1
+    values = numpy.zeros(len(ends), dtype=numpy.uint64)
+    for byte in range(10):
+        index = starts + byte
+        live = index <= ends
+        if not live.any():
+            break
+        values[live] |= (data[index[live]] & 0x7f).astype(numpy.uint64) << numpy.uint64(7 * byte)
+    return values, ends
+
+
+def zigzag(values):
+    return (values >> numpy.uint64(1)).astype(numpy.int64) ^ -(values & numpy.uint64(1)).astype(numpy.int64)
+
+
+def deltas(buf):
+    return numpy.cumsum(zigzag(packed(buf)[0]))
+
+
+def segments(bufs):
+    ''' Decode a list of packed varint fields at once. Returns (owner, values) where
+        owner is the index of the field each value came from.
+    '''
+    data = b''.join(bufs)
+    (values, ends) = packed(data)
+    limits = numpy.cumsum(numpy.fromiter(map(len, bufs), dtype=numpy.int64, count=len(bufs)))
+    return numpy.searchsorted(limits, ends, side='right'), values.astype(numpy.int64)
+
+
+def split_deltas(bufs):
+    ''' Decode a list of delta coded packed sint64 fields at once into a list of arrays '''
+    (owner, values) = segments(bufs)
+    values = numpy.cumsum(zigzag(values.astype(numpy.uint64)))
+    bounds = numpy.searchsorted(owner, numpy.arange(1, len(bufs)))
+    # Deltas restart with every field
+    base = numpy.concatenate(([0], values[bounds - 1]))
+    base[1:][bounds == 0] = 0
+    counts = numpy.diff(numpy.concatenate(([0], bounds, [len(values)])))
+    return numpy.split(values - numpy.repeat(base, counts), bounds)
+
+
+def match(conditions, owner, keys, vals, count):
+    ''' Mask of the count elements whose (owner, key, val) tag pairs satisfy all conditions '''
+    mask = numpy.ones(count, dtype=bool)
+    for key, value in conditions:
+        hit = keys == key if value is None else (keys == key) & (vals == value)
+        found = numpy.zeros(count, dtype=bool)
+        found[owner[hit]] = True
+        mask &= found
+    return mask
+
+
+def tag_values(strings, index, key, owner, keys, vals, selected, count):
+    ''' Values of tag key for the selected elements, None where they do not have it '''
+    if key not in index:
+        return [None] * len(selected)
+    value = numpy.full(count, -1, dtype=numpy.int64)
+    hit = keys == index[key]
+    value[owner[hit]] = vals[hit]
+    return [strings[v] if v >= 0 else None for v in value[selected].tolist()]
+
+
+def contained(ids, wanted):
+    ''' Mask of the ids contained in the sorted array wanted '''
+    if not len(wanted):
+        return numpy.zeros(len(ids), dtype=bool)
+    return wanted[numpy.minimum(numpy.searchsorted(wanted, ids), len(wanted) - 1)] == ids
+
+
+def blob_data(blob):
+    zlib_data = None
+    for field, value in fields(memoryview(blob)):
+        if field == 1:
+            return bytes(value)
+        elif field == 3:
+            zlib_data = value
+        elif field in (4, 5, 6, 7):
+            raise ValueError('Only raw and zlib compressed PBF blobs are supported')
+    return zlib.decompress(zlib_data)
+
+
+def list_blobs(path):
+    ''' (offset, size) of every OSMData blob of the file; checks the OSMHeader features '''
+    blobs = []
+    with open(path, 'rb') as f:
+        while length := f.read(4):
+            header = dict(fields(memoryview(f.read(struct.unpack('>I', length)[0]))))
+            kind = bytes(header[1]).decode('utf-8')
+            size = header[3]
+            if kind == 'OSMHeader':
+                for field, value in fields(memoryview(blob_data(f.read(size)))):
+                    if field == 4 and bytes(value).decode('utf-8') not in SUPPORTED_FEATURES:
+                        raise ValueError(f'Unsupported PBF feature {bytes(value).decode("utf-8")}')
+                continue
+            if kind == 'OSMData':
+                blobs.append((f.tell(), size))
+            f.seek(size, 1)
+    return blobs
+
+
+class Block(object):
+    ''' A decoded PrimitiveBlock '''
+
+    def __init__(self, data):
+        self.strings = []
+        self.groups = []
+        self.granularity, self.lat_offset, self.lon_offset = 100, 0, 0
+        for field, value in fields(memoryview(data)):
+            if field == 1:
+                self.strings = [bytes(s).decode('utf-8') for _, s in fields(value)]
+            elif field == 2:
+                self.groups.append(value)
+            elif field == 17:
+                self.granularity = value
+            elif field == 19:
+                self.lat_offset = int64(value)
+            elif field == 20:
+                self.lon_offset = int64(value)
+        self.index = {s: i for i, s in enumerate(self.strings)}
+
+    def coordinates(self, lon, lat):
+        # Dividing the exact nanodegrees rounds like parsing Overpass' decimal output
+        return ((self.lon_offset + self.granularity * numpy.asarray(lon, dtype=numpy.int64)) / 1e9,
+                (self.lat_offset + self.granularity * numpy.asarray(lat, dtype=numpy.int64)) / 1e9)
+
+    def nodes(self, group, tags=True):
+        ''' (ids, lon, lat, owner, keys, vals) of the nodes of a group, dense or not.
+            owner, keys and vals list every tag as the index of its node and string ids.
+        '''
+        ids, lon, lat = [], [], []
+        owner = keys = vals = numpy.empty(0, dtype=numpy.int64)
+        plain_keys, plain_vals = [], []
+        for field, value in fields(group):
+            if field == 2:
+                dense = dict(fields(value))
+                (ids, lat, lon) = (deltas(dense.get(f, b'')) for f in (1, 8, 9))
+                if tags and 10 in dense:
+                    # key, value, key, value, ..., 0 for every node
+                    keys_vals = packed(dense[10])[0].astype(numpy.int64)
+                    separator = keys_vals == 0
+                    node = numpy.cumsum(separator) - separator
+                    first = numpy.concatenate(([0], numpy.flatnonzero(separator) + 1))
+                    pairs = numpy.flatnonzero(~separator)
+                    pairs = pairs[(pairs - first[node[pairs]]) % 2 == 0]
+                    (owner, keys, vals) = (node[pairs], keys_vals[pairs], keys_vals[pairs + 1])
+            elif field == 1:
+                node = dict(fields(value))
+                ids.append(unzigzag(node.get(1, 0)))
+                lat.append(unzigzag(node.get(8, 0)))
+                lon.append(unzigzag(node.get(9, 0)))
+                plain_keys.append(node.get(2, b''))
+                plain_vals.append(node.get(3, b''))
+        if tags and plain_keys:
+            (owner, keys) = segments(plain_keys)
+            vals = segments(plain_vals)[1]
+        return (numpy.asarray(ids, dtype=numpy.int64), *self.coordinates(lon, lat), owner, keys, vals)
+
+    def members(self, group, kind):
+        ''' (ids, fields) of the ways or relations of a group, fields mapping field number to value '''
+        ids, members = [], []
+        for field, value in fields(group):
+            if field == (WAY_FIELD if kind == WAY else RELATION_FIELD):
+                member = dict(fields(value))
+                ids.append(member.get(1, 0))
+                members.append(member)
+        return numpy.array(ids, dtype=numpy.int64), members
+
+    def ids(self, group, kind):
+        ''' Only the ids of the ways or relations of a group '''
+        ids = []
+        for field, value in fields(group):
+            if field == (WAY_FIELD if kind == WAY else RELATION_FIELD):
+                (number, id_) = next(fields(value), (1, 0))
+                ids.append(id_ if number == 1 else dict(fields(value)).get(1, 0))
+        return numpy.array(ids, dtype=numpy.int64)
+
+    def tags(self, keys, vals, wanted):
+        own = dict(zip(keys, vals))
+        return {key: self.strings[own[self.index[key]]] if self.index.get(key) in own else None for key in wanted}
+
+
+def group_kind(group):
+    field = varint(group, 0)[0] >> 3 if len(group) else 0
+    return {1: NODE, 2: NODE, 3: WAY, 4: RELATION}.get(field)
+
+
+_file = None
+_filters = None
+_wanted = None
+
+
+def _init(path, filters, wanted=None):
+    global _file, _filters, _wanted
+    _file = open(path, 'rb')
+    _filters = filters
+    _wanted = wanted
+
+
+def _block(offset, size):
+    _file.seek(offset)
+    return Block(blob_data(_file.read(size)))
+
+
+def _scan(blob):
+    ''' First pass: id ranges and the elements matching each category '''
+    block = _block(*blob)
+    result = {'ranges': [], 'nodes': {}, 'ways': {}, 'relations': {}}
+    for group in block.groups:
+        kind = group_kind(group)
+        if kind is None:
+            continue
+        compiled = {name: f.compile(block.index) for name, f in _filters.items() if kind in f.types}
+        compiled = {name: conditions for name, conditions in compiled.items() if conditions is not None}
+
+        if kind == NODE:
+            (ids, lon, lat, owner, keys, vals) = block.nodes(group, bool(compiled))
+            for name, conditions in compiled.items():
+                selected = numpy.flatnonzero(match(conditions, owner, keys, vals, len(ids)))
+                if len(selected):
+                    tags = {key: tag_values(block.strings, block.index, key, owner, keys, vals, selected, len(ids)) for key in _filters[name].tags}
+                    result['nodes'].setdefault(name, []).append((ids[selected], lon[selected], lat[selected], tags))
+        elif not compiled:
+            ids = block.ids(group, kind)
+        else:
+            (ids, members) = block.members(group, kind)
+            (owner, keys) = segments([member.get(2, b'') for member in members])
+            vals = segments([member.get(3, b'') for member in members])[1]
+            for name, conditions in compiled.items():
+                selected = numpy.flatnonzero(match(conditions, owner, keys, vals, len(ids))).tolist()
+                if kind == WAY and selected:
+                    refs = split_deltas([members[i].get(8, b'') for i in selected])
+                for n, i in enumerate(selected):
+                    member = members[i]
+                    tags = block.tags(keys[owner == i].tolist(), vals[owner == i].tolist(), _filters[name].tags)
+                    if kind == WAY:
+                        result['ways'].setdefault(name, []).append((int(ids[i]), refs[n], tags))
+                    else:
+                        roles = [block.strings[role] for role in packed(member.get(8, b''))[0].tolist()]
+                        types = packed(member.get(10, b''))[0].astype(numpy.int64)
+                        result['relations'].setdefault(name, []).append((int(ids[i]), types, deltas(member.get(9, b'')), roles, tags))
+        if len(ids):
+            result['ranges'].append((kind, int(ids.min()), int(ids.max())))
+    return result
+
+
+def _way_nodes(blob):
+    ''' Second pass: node ids of the wanted ways '''
+    block = _block(*blob)
+    result = {}
+    for group in block.groups:
+        if group_kind(group) == WAY:
+            (ids, members) = block.members(group, WAY)
+            for i in numpy.flatnonzero(contained(ids, _wanted)).tolist():
+                result[int(ids[i])] = deltas(members[i].get(8, b''))
+    return result
+
+
+def _coordinates(blob):
+    ''' Third pass: coordinates of the wanted nodes '''
+    block = _block(*blob)
+    result = []
+    for group in block.groups:
+        if group_kind(group) == NODE:
+            (ids, lon, lat) = block.nodes(group, False)[:3]
+            selected = contained(ids, _wanted)
+            result.append((ids[selected], lon[selected], lat[selected]))
+    return result
+
+
+def run(path, function, blobs, workers, filters, wanted=None):
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init, initargs=(path, filters, wanted)) as executor:
+        return list(executor.map(function, blobs, chunksize=max(1, len(blobs) // (8 * (workers or os.cpu_count() or 1)))))
+
+
+def containing(ranges, kind, wanted):
+    ''' Blobs whose id range of the given kind contains one of the sorted wanted ids '''
+    blobs = []
+    for (blob, low, high) in ranges[kind]:
+        i = numpy.searchsorted(wanted, low)
+        if i < len(wanted) and wanted[i] <= high:
+            blobs.append(blob)
+    return blobs
+
+
+def locate(refs, ids, lon, lat):
+    ''' Coordinates of the nodes refs, given the sorted ids of the known nodes and their
+        coordinates. NaN where a node is not known.
+    '''
+    if not len(ids):
+        return numpy.full(len(refs), numpy.nan), numpy.full(len(refs), numpy.nan)
+    index = numpy.minimum(numpy.searchsorted(ids, refs), len(ids) - 1)
+    known = ids[index] == refs
+    return numpy.where(known, lon[index], numpy.nan), numpy.where(known, lat[index], numpy.nan)
+
+
+def centers(groups, ids, lon, lat):
+    ''' Bounding box centers of groups of node ids, NaN where none of a group's nodes is known '''
+    lengths = numpy.array([len(group) for group in groups], dtype=numpy.int64)
+    if not lengths.sum():
+        return numpy.full(len(groups), numpy.nan), numpy.full(len(groups), numpy.nan)
+    result = []
+    # reduceat over the non-empty groups only, an empty group would cut its predecessor short
+    filled = lengths > 0
+    starts = (numpy.cumsum(lengths) - lengths)[filled]
+    for values in locate(numpy.concatenate(groups), ids, lon, lat):
+        center = numpy.full(len(groups), numpy.nan)
+        center[filled] = (numpy.fmin.reduceat(values, starts) + numpy.fmax.reduceat(values, starts)) / 2
+        result.append(center)
+    return result
+
+
+def read(path, categories, workers=None):
+    ''' Read categories, a dict of name to (Overpass statement, tag keys to keep), from
+        the extract at path. Returns a dict of name to Elements.
+    '''
+    filters = {name: Filter(statement, tags) for name, (statement, tags) in categories.items()}
+    blobs = list_blobs(path)
+
+    ranges = {NODE: [], WAY: [], RELATION: []}
+    found = {kind: {name: [] for name in filters} for kind in ('nodes', 'ways', 'relations')}
+    with tracing.span('pbf_scan', rows=len(blobs)):
+        for blob, result in zip(blobs, run(path, _scan, blobs, workers, filters)):
+            for (kind, low, high) in result['ranges']:
+                ranges[kind].append((blob, low, high))
+            for kind in found:
+                for name, items in result[kind].items():
+                    found[kind][name] += items
+
+    # Member ways of relations that need a center
+    wanted = numpy.unique(numpy.concatenate([numpy.empty(0, dtype=numpy.int64)] + [
+        refs[types == WAY] for name, f in filters.items() if not f.geom for (_, types, refs, _, _) in found['relations'][name]]))
+    way_nodes = {}
+    if len(wanted):
+        with tracing.span('pbf_way_nodes', rows=len(wanted)):
+            for result in run(path, _way_nodes, containing(ranges, WAY, wanted), workers, filters, wanted):
+                way_nodes.update(result)
+
+    # Nodes of matching ways and relations
+    wanted = [numpy.empty(0, dtype=numpy.int64)] + list(way_nodes.values())
+    for name, f in filters.items():
+        if not f.geom:
+            wanted += [refs for (_, refs, _) in found['ways'][name]]
+        wanted += [refs[types == NODE] for (_, types, refs, _, _) in found['relations'][name]]
+    wanted = numpy.unique(numpy.concatenate(wanted))
+    (ids, lon, lat) = (numpy.empty(0, dtype=numpy.int64), numpy.empty(0), numpy.empty(0))
+    if len(wanted):
+        with tracing.span('pbf_coordinates', rows=len(wanted)):
+            parts = [part for result in run(path, _coordinates, containing(ranges, NODE, wanted), workers, filters, wanted) for part in result]
+        if parts:
+            (ids, lon, lat) = (numpy.concatenate(column) for column in zip(*parts))
+            order = numpy.argsort(ids, kind='stable')
+            (ids, lon, lat) = (ids[order], lon[order], lat[order])
+
+    data = {}
+    for name, f in filters.items():
+        elements = data[name] = Elements(f.tags)
+        for (node_ids, node_lon, node_lat, tags) in found['nodes'][name]:
+            for i in range(len(node_ids)):
+                elements.append('node', int(node_ids[i]), float(node_lon[i]), float(node_lat[i]), {key: values[i] for key, values in tags.items()})
+
+        ways = found['ways'][name]
+        # out geom has no center for ways
+        (way_lon, way_lat) = centers([refs for (_, refs, _) in ways] if not f.geom else [()] * len(ways), ids, lon, lat)
+        for (way_id, _, tags), x, y in zip(ways, way_lon, way_lat):
+            elements.append('way', way_id, float(x), float(y), tags)
+
+        relations = found['relations'][name]
+        if f.geom:
+            for (relation_id, types, refs, roles, tags) in relations:
+                elements.append('relation', relation_id, numpy.nan, numpy.nan, tags)
+                nodes = refs[types == NODE]
+                (x, y) = locate(nodes, ids, lon, lat)
+                for ref, role, node_x, node_y in zip(nodes.tolist(), [role for role, t in zip(roles, types.tolist()) if t == NODE], x, y):
+                    if not numpy.isnan(node_x):
+                        elements.append('node', ref, float(node_x), float(node_y), {}, role)
+        else:
+            groups = [numpy.concatenate([refs[types == NODE]] + [way_nodes.get(ref, numpy.empty(0, dtype=numpy.int64)) for ref in refs[types == WAY].tolist()])
+                      for (_, types, refs, _, _) in relations]
+            (relation_lon, relation_lat) = centers(groups, ids, lon, lat)
+            for (relation_id, _, _, _, tags), x, y in zip(relations, relation_lon, relation_lat):
+                elements.append('relation', relation_id, float(x), float(y), tags)
+    return data
@@ -22,67 +22,175 @@ import sys
 import os
 import configparser
 import hashlib
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import tracing
 
 checkSumSize = 524288
+bufferSize = 1048576
 
 def file_sha1(path, checkSumSize = 0):
-  with open(path,'rb') as f:
+  ''' Return (length, digest) of a file, or (length, [digests]) of each checkSumSize
+      block if checkSumSize is set. Reads through a fixed size buffer, so memory use
+      does not depend on the file size.
+  '''
+  buf = bytearray(checkSumSize or bufferSize)
+  view = memoryview(buf)
+  with open(path,'rb', buffering=0) as f:
     if checkSumSize!=0:
       l = 0
       digests = []
       while True:
         hasher=hashlib.sha1()
-        buf = f.read(checkSumSize)
-        hasher.update(buf)
-        if len(buf)==0:
+        n = f.readinto(buf)
+        while n and n < checkSumSize:
+          # a short read is not necessarily the end of the file
+          m = f.readinto(view[n:])
+          if not m:
+            break
+          n += m
+        hasher.update(view[:n])
+        if n==0:
           break
-        l += len(buf)
+        l += n
         digests.append(hasher.hexdigest())
       return ( l, digests )
     else:
       hasher=hashlib.sha1()
-      buf = f.read()
-      hasher.update(buf)
-      return ( len(buf), hasher.hexdigest() )
-
-def generate_hashes(base):
+      l = 0
+      while n := f.readinto(buf):
+        hasher.update(view[:n])
+        l += n
+      return ( l, hasher.hexdigest() )
+
+class Hasher(object):
+  ''' Hashes files on a thread pool (hashlib releases the GIL) and remembers the
+      results in an optional JSON manifest keyed by path, size, mtime and inode, so
+      files that have not changed since the last run are not read again.
+      Results computed elsewhere (e.g. while packaging) can be added with seed().
+  '''
+
+  def __init__(self, manifest=None, workers=None):
+    self.manifest = manifest
+    self.workers = workers or min(32, (os.cpu_count() or 1) + 4)
+    self.entries = {}
+    if manifest is not None and os.path.exists(manifest):
+      with open(manifest) as f:
+        self.entries = json.load(f)
+
+  def key(self, path):
+    st = os.stat(path)
+    return ( os.path.abspath(path), [ st.st_size, st.st_mtime_ns, st.st_ino ] )
+
+  def seed(self, path, checkSumSize, result):
+    ( abspath, stamp ) = self.key(path)
+    entry = self.entries.get(abspath)
+    if entry is None or entry['stamp'] != stamp:
+      entry = self.entries[abspath] = { 'stamp': stamp }
+    entry[str(checkSumSize)] = result
+
+  def file_sha1(self, path, checkSumSize = 0):
+    ( abspath, stamp ) = self.key(path)
+    entry = self.entries.get(abspath)
+    if entry is not None and entry['stamp'] == stamp and str(checkSumSize) in entry:
+      return tuple(entry[str(checkSumSize)])
+
+    result = file_sha1(path, checkSumSize)
+    self.seed(path, checkSumSize, result)
+    return result
+
+  def map(self, paths, checkSumSize = 0):
+    with ThreadPoolExecutor(max_workers=self.workers) as executor:
+      return list(executor.map(lambda path: self.file_sha1(path, checkSumSize), paths))
+
+  def save(self):
+    if self.manifest is not None:
+      # A file modified within the last couple of seconds could change again without
+      # its mtime moving on, so do not trust it next time
+      racy = time.time_ns() - 2000000000
+      entries = { k: v for k, v in self.entries.items() if v['stamp'][1] < racy }
+      tmp = self.manifest + '.tmp'
+      with open(tmp,'w') as f:
+        json.dump(entries, f)
+      os.replace(tmp, self.manifest)
+
+def hashed_files(base):
+  ''' The files listed in the hashes.txt of directory base, in order '''
+  files = []
+  for path,dnames,fnames in os.walk(base):
+    for f in sorted(fnames):
+      if f!='hashes.txt':
+        files.append((path,f))
+  return files
+
+def generate_hashes(base, hasher=None):
+  hasher = hasher or Hasher()
   size = 0
   hashes = os.path.join( base, "hashes.txt" )
+
+  files = hashed_files(base)
+  with tracing.span('hash_files', rows=len(files)):
+    results = hasher.map([ os.path.join(path,f) for (path,f) in files ], checkSumSize)
+
   with open(hashes,'w') as fd:
-    for path,dnames,fnames in os.walk(base):
-      for f in sorted(fnames):
-        if f!='hashes.txt':
-          (length, digests) = file_sha1( os.path.join(path,f), checkSumSize )
-          relpath = os.path.relpath(path,base)
-          if relpath != '.':
-            f = os.path.join(relpath,f).replace(os.sep,'/')
-          fd.write(f'FileName = "{f}"\n')
-          fd.write(f'FileSize = "{str(length)}"\n')
-          fd.write(f'CheckSumSize = "{checkSumSize}"\n')
-          for i, digest in enumerate(digests):
-            suffix = '' if i==0 else str(i)
-            fd.write('CheckSum%s = "%s"\n' % (suffix,digest))
-          fd.write('\n')
-          size += length
+    for ((path,f),(length,digests)) in zip(files,results):
+      relpath = os.path.relpath(path,base)
+      if relpath != '.':
+        f = os.path.join(relpath,f).replace(os.sep,'/')
+      fd.write(f'FileName = "{f}"\n')
+      fd.write(f'FileSize = "{str(length)}"\n')
+      fd.write(f'CheckSumSize = "{checkSumSize}"\n')
+      for i, digest in enumerate(digests):
+        suffix = '' if i==0 else str(i)
+        fd.write('CheckSum%s = "%s"\n' % (suffix,digest))
+      fd.write('\n')
+      size += length
 
   return ( hashes, size )
 
-def dir_sha1(path):
-  ( hashes, length ) = generate_hashes(path)
+def dir_sha1(path, hasher=None):
+  ( hashes, length ) = generate_hashes(path, hasher)
   ( tmp, digest ) = file_sha1(hashes)
   return ( length, digest )
 
 
-def fix(base):
+def read_metainfo(metainfo_path):
+  config = configparser.ConfigParser()
+  config.optionxform=str # make case sensitive
+
+  config.read_file(open(metainfo_path))
+  return config
+
+def section_source(config, section):
+  ''' Path, relative to base, of the directory or file a \\Dir or \\File section refers to '''
+  section_os = section.rsplit('\\',1)[0].replace('\\',os.sep)
+  source = config[section]['Source'].strip('"').replace('/',os.sep) if config.has_option(section,'Source') else ''
+  return os.path.join(section_os,source)
+
+def checksum_requests(base):
+  ''' List the (path, checkSumSize) pairs that fix(base) is going to hash '''
+  config = read_metainfo(os.path.join(base,"metainfo2.txt"))
+  requests = []
+  for section in config.sections():
+    if section.endswith('\\Dir'):
+      requests += [ (os.path.join(path,f), checkSumSize) for (path,f) in hashed_files(os.path.join(base,section_source(config,section))) ]
+    elif section.endswith('\\File'):
+      requests.append((os.path.join(base,section_source(config,section)), 0))
+  return requests
+
+def fix(base, manifest=None, hasher=None):
+  with tracing.span('poifix', base=os.path.basename(os.path.normpath(base))):
+    _fix(base, hasher or Hasher(manifest))
+
+def _fix(base, hasher):
   #
   # Read the metainfo2.txt configuration
   #
   metainfo_path = os.path.join(base,"metainfo2.txt")
 
-  config = configparser.ConfigParser()
-  config.optionxform=str # make case sensitive
-
-  config.read_file(open(metainfo_path))
+  config = read_metainfo(metainfo_path)
 
   for section in config.sections():
 
@@ -93,10 +201,8 @@ def fix(base):
       # CheckSum = SHA1 hash of hashes.txt file
       # FileSize = Total size of all files referred to in hashes.txt file
       #
-      section_os = section[:-4].replace('\\',os.sep)
-      source = config[section]['Source'].strip('"').replace('/',os.sep) if config.has_option(section,'Source') else ''
-      source = os.path.join(section_os,source)
-      (length,digest) = dir_sha1( os.path.join(base,source) )
+      source = section_source(config,section)
+      (length,digest) = dir_sha1( os.path.join(base,source), hasher )
       config[section]['FileSize'] = f'"{length}"'
       config[section]['CheckSum'] = f'"{digest}"'
     elif section.endswith('\\File'):
@@ -105,10 +211,8 @@ def fix(base):
       # CheckSum = SHA1 hash of file
       # FileSize = Size of file in bytes
       #
-      section_os = section[:-5].replace('\\',os.sep)
-      source = config[section]['Source'].strip('"').replace('/',os.sep) if config.has_option(section,'Source') else ''
-      source = os.path.join(section_os,source)
-      (length,digest) = file_sha1( os.path.join(base,source) )
+      source = section_source(config,section)
+      (length,digest) = hasher.file_sha1( os.path.join(base,source) )
       config[section]['FileSize'] = f'"{length}"'
       config[section]['CheckSum'] = f'"{digest}"'
 
@@ -131,12 +235,14 @@ def fix(base):
   with open(metainfo_path,"w") as configfile:
     config.write(configfile)
 
+  hasher.save()
+
 
 if __name__ == "__main__":
-  if len(sys.argv)!=2:
-    print(f"usage: {sys.argv[0]} <path to MIB2HIGH or MIB2TSD directory>")
+  if len(sys.argv) not in (2,3):
+    print(f"usage: {sys.argv[0]} <path to MIB2HIGH or MIB2TSD directory> [manifest]")
     sys.exit(1)
 
   base = sys.argv[1]
 
-  fix(base)
+  fix(base, sys.argv[2] if len(sys.argv)==3 else None)
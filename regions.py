@@ -0,0 +1,72 @@
+import glob
+import json
+import os
+
+import shapely
+from shapely.geometry import shape
+
+import spatial
+
+'''
+The regions a build publishes packages for.
+
+A region is data, one GeoJSON Feature per file in the regions directory:
+
+    geometry    the (Multi)Polygon the POIs of the package lie in
+    name        the region's name, as listed in [General] Regions
+    title       the name of the package shown on the unit
+    package     the file name of the release zip, without .zip
+    areas       OSM area relation ids by name, fetched by the per-area queries
+
+One fetch covers all regions of a build: the tiles of the union of their polygons,
+or the union of their areas. Each region then keeps the POIs within its polygon.
+'''
+
+DIRECTORY = 'regions'
+
+# Containment tests built in this process, by region name
+_containment = {}
+
+
+class Region(object):
+    def __init__(self, name, polygon, areas, package, title=None):
+        self.name = name
+        self.polygon = polygon
+        self.areas = areas
+        self.package = package
+        self.title = title or name
+
+    def contains(self, lon, lat):
+        if self.name not in _containment:
+            _containment[self.name] = spatial.Containment(self.polygon)
+        return _containment[self.name].contains(lon, lat)
+
+
+def load(path):
+    with open(path, encoding='utf-8') as f:
+        feature = json.load(f)
+    properties = feature['properties']
+    return Region(properties['name'], shape(feature['geometry']), properties.get('areas', {}), properties['package'],
+                  properties.get('title'))
+
+
+def read_regions(names, directory=DIRECTORY):
+    ''' The regions of the given names, in that order '''
+    regions = {}
+    for path in sorted(glob.glob(os.path.join(directory, '*.json'))):
+        region = load(path)
+        regions[region.name] = region
+    unknown = [name for name in names if name not in regions]
+    if unknown:
+        raise ValueError(f'Unknown region {", ".join(unknown)}, expected one of {", ".join(regions)}')
+    return [regions[name] for name in names]
+
+
+def coverage(regions):
+    ''' The polygon and the areas covering all regions '''
+    areas = {}
+    for region in regions:
+        areas.update(region.areas)
+    if len(regions) == 1:
+        return regions[0].polygon, areas
+    return shapely.union_all([region.polygon for region in regions]), areas
@@ -0,0 +1,242 @@
+import numpy
+import shapely
+
+'''
+Vectorized spatial helpers that work directly on lon/lat arrays.
+'''
+
+
+class Containment(object):
+    ''' Point-in-polygon test for large lon/lat arrays.
+
+        Points outside the polygon's bounding box are rejected first. The bounding
+        box is covered by a grid of cells that are classified once as fully inside,
+        fully outside or on the boundary of the polygon; only points in boundary
+        cells are tested exactly with shapely.contains_xy on the prepared polygon.
+        With grid=0 every point inside the bounding box is tested exactly.
+        Like predicate='within', points on the boundary are not contained.
+    '''
+
+    INSIDE, OUTSIDE, BOUNDARY = 0, 1, 2
+
+    def __init__(self, polygon, grid=128):
+        self.polygon = polygon
+        shapely.prepare(polygon)
+        (self.minx, self.miny, self.maxx, self.maxy) = polygon.bounds
+        self.grid = grid
+        if not grid:
+            self.cells = None
+            return
+        self.dx = (self.maxx - self.minx) / grid
+        self.dy = (self.maxy - self.miny) / grid
+
+        # Cells are slightly enlarged so points on a cell edge are classified safely
+        eps = 1e-9
+        ix, iy = numpy.meshgrid(numpy.arange(grid), numpy.arange(grid), indexing='ij')
+        cells = shapely.box(self.minx + ix * self.dx - eps, self.miny + iy * self.dy - eps,
+                            self.minx + (ix + 1) * self.dx + eps, self.miny + (iy + 1) * self.dy + eps)
+        self.cells = numpy.full((grid, grid), self.BOUNDARY, dtype=numpy.uint8)
+        self.cells[shapely.contains_properly(polygon, cells)] = self.INSIDE
+        self.cells[~shapely.intersects(polygon, cells)] = self.OUTSIDE
+
+    def contains(self, lon, lat):
+        lon = numpy.asarray(lon, dtype=numpy.float64)
+        lat = numpy.asarray(lat, dtype=numpy.float64)
+        mask = (lon >= self.minx) & (lon <= self.maxx) & (lat >= self.miny) & (lat <= self.maxy)
+
+        candidates = numpy.flatnonzero(mask)
+        if self.cells is None:
+            mask[candidates] = shapely.contains_xy(self.polygon, lon[candidates], lat[candidates])
+            return mask
+
+        ix = numpy.minimum(((lon[candidates] - self.minx) / self.dx).astype(numpy.intp), self.grid - 1)
+        iy = numpy.minimum(((lat[candidates] - self.miny) / self.dy).astype(numpy.intp), self.grid - 1)
+        cell = self.cells[ix, iy]
+
+        mask[candidates[cell == self.OUTSIDE]] = False
+        boundary = candidates[cell == self.BOUNDARY]
+        mask[boundary] = shapely.contains_xy(self.polygon, lon[boundary], lat[boundary])
+        return mask
+
+
+# Metres per degree of latitude, and of longitude at the equator
+METRES_PER_DEGREE = 110574.0, 111320.0
+
+
+def column_width(row, size):
+    ''' Degrees of longitude of the columns of the given rows of a size metre grid, at
+        least size metres wide at the poleward edge of their row
+    '''
+    height = size / METRES_PER_DEGREE[0]
+    edge = numpy.minimum(numpy.maximum(numpy.abs(row), numpy.abs(row + 1)) * height, 89.0)
+    return size / (METRES_PER_DEGREE[1] * numpy.cos(numpy.radians(edge)))
+
+
+def grid_cells(lon, lat, size):
+    ''' Column and row of every point in a grid of rows size metres high, each divided
+        into columns as narrow as its latitude allows (see column_width)
+    '''
+    cy = numpy.floor(lat / (size / METRES_PER_DEGREE[0])).astype(numpy.int64)
+    cx = numpy.floor(lon / column_width(cy, size)).astype(numpy.int64)
+    return cx, cy
+
+
+def neighbours(lon, lat, radius):
+    ''' All pairs (i, j), i < j, of points less than radius metres apart.
+
+        Points are hashed into a grid of cells at least radius wide, so only points in
+        the same or adjacent cells need to be compared. Every row has its own column
+        width, so cells stay about radius wide at any latitude, and the cells of the
+        next row are matched by their longitude range. Distances are equirectangular,
+        which is exact enough at POI scale.
+    '''
+    lon = numpy.asarray(lon, dtype=numpy.float64)
+    lat = numpy.asarray(lat, dtype=numpy.float64)
+    empty = numpy.empty(0, dtype=numpy.intp)
+    if len(lon) < 2 or radius <= 0:
+        return empty, empty
+
+    (cx, cy) = grid_cells(lon, lat, radius)
+    # Room for the columns one beyond either end
+    (x0, span) = (int(cx.min()) - 1, int(cx.max() - cx.min()) + 3)
+    y0 = int(cy.min())
+
+    def cell_key(column, row):
+        return (row - y0) * span + (column - x0)
+
+    key = cell_key(cx, cy)
+    order = numpy.argsort(key, kind='stable')
+    (cells, starts, counts) = numpy.unique(key[order], return_index=True, return_counts=True)
+    (column, row) = (cells % span + x0, cells // span + y0)
+
+    def cell_pairs(a, b):
+        ''' The point pairs of the cell pairs (a[k], b[k]) '''
+        sizes = counts[a] * counts[b]
+        local = numpy.arange(sizes.sum()) - numpy.repeat(numpy.cumsum(sizes) - sizes, sizes)
+        i = numpy.repeat(starts[a], sizes) + local // numpy.repeat(counts[b], sizes)
+        j = numpy.repeat(starts[b], sizes) + local % numpy.repeat(counts[b], sizes)
+        return i, j
+
+    # The same cell, every pair once
+    everything = numpy.arange(len(cells))
+    (i, j) = cell_pairs(everything, everything)
+    (first, second) = ([i[i < j]], [j[i < j]])
+
+    # The next cell of the same row
+    index = numpy.searchsorted(cells, cells + 1)
+    found = index < len(cells)
+    found[found] &= cells[index[found]] == cells[found] + 1
+    (i, j) = cell_pairs(numpy.flatnonzero(found), index[found])
+    first.append(i)
+    second.append(j)
+
+    # The cells of the next row within one column width of either edge of the cell
+    (width, above) = (column_width(row, radius), column_width(row + 1, radius))
+    reach = numpy.maximum(width, above)
+    low = numpy.clip(numpy.floor((column * width - reach) / above), x0, x0 + span - 1).astype(numpy.int64)
+    high = numpy.clip(numpy.floor(((column + 1) * width + reach) / above), x0, x0 + span - 1).astype(numpy.int64)
+    lo = numpy.searchsorted(cells, cell_key(low, row + 1), side='left')
+    hi = numpy.searchsorted(cells, cell_key(high, row + 1), side='right')
+    matches = hi - lo
+    a = numpy.repeat(everything, matches)
+    b = numpy.arange(matches.sum()) - numpy.repeat(numpy.cumsum(matches) - matches, matches) + numpy.repeat(lo, matches)
+    (i, j) = cell_pairs(a, b)
+    first.append(i)
+    second.append(j)
+
+    (i, j) = (order[numpy.concatenate(first)], order[numpy.concatenate(second)])
+
+    dx = (lon[i] - lon[j]) * METRES_PER_DEGREE[1] * numpy.cos(numpy.radians((lat[i] + lat[j]) / 2))
+    dy = (lat[i] - lat[j]) * METRES_PER_DEGREE[0]
+    close = dx * dx + dy * dy < radius * radius
+    (i, j) = (i[close], j[close])
+    return numpy.minimum(i, j), numpy.maximum(i, j)
+
+
+# Vectorized rounds of dedupe before the rest is resolved by a sequential sweep
+DEDUPE_ROUNDS = 8
+
+
+def dedupe(lon, lat, radius, score=None):
+    ''' Mask of the points to keep so that no two kept points are less than radius
+        metres apart. Points are considered best first (highest score, then lowest
+        index) and a point is dropped if a better point within radius is kept, the
+        same result as a sequential greedy pass. Most points are resolved in a few
+        vectorized rounds; each round settles one link of every chain of ever better
+        neighbours, so after DEDUPE_ROUNDS rounds the points left on long chains are
+        swept once in rank order. Time is linear in the points and close pairs.
+    '''
+    n = len(lon)
+    keep = numpy.ones(n, dtype=bool)
+    (i, j) = neighbours(lon, lat, radius)
+    if not len(i):
+        return keep
+
+    # Orient every pair as (better, worse)
+    if score is not None:
+        score = numpy.asarray(score)
+        swap = score[j] > score[i]
+        (i, j) = (numpy.where(swap, j, i), numpy.where(swap, i, j))
+
+    UNDECIDED, KEPT, DROPPED = 0, 1, 2
+    state = numpy.full(n, UNDECIDED, dtype=numpy.uint8)
+    state[numpy.bincount(j, minlength=n) == 0] = KEPT
+    for _ in range(DEDUPE_ROUNDS):
+        if not len(j):
+            break
+        hit = state[i] == KEPT
+        state[j[hit & (state[j] == UNDECIDED)]] = DROPPED
+        blocked = numpy.bincount(j[state[i] != DROPPED], minlength=n) > 0
+        state[(state == UNDECIDED) & ~blocked] = KEPT
+        pending = state[j] == UNDECIDED
+        (i, j) = (i[pending], j[pending])
+
+    # Points kept by the last round have not dropped their worse neighbours yet
+    state[j[(state[i] == KEPT) & (state[j] == UNDECIDED)]] = DROPPED
+    undecided = numpy.flatnonzero(state == UNDECIDED)
+    if len(undecided):
+        # Better points come first, and a kept point drops its worse neighbours
+        rank = undecided[numpy.lexsort((undecided, -score[undecided]))] if score is not None else undecided
+        by_better = numpy.argsort(i, kind='stable')
+        starts = numpy.searchsorted(i[by_better], numpy.arange(n + 1)).tolist()
+        worse = j[by_better].tolist()
+        decided = bytearray(state.tobytes())
+        for point in rank.tolist():
+            if decided[point] == UNDECIDED:
+                decided[point] = KEPT
+                for other in worse[starts[point]:starts[point + 1]]:
+                    decided[other] = DROPPED
+        state = numpy.frombuffer(decided, dtype=numpy.uint8)
+    keep[state == DROPPED] = False
+    return keep
+
+
+def thin(lon, lat, limit, size, score=None):
+    ''' Mask of at most limit points to keep, taken from the densest cells of a grid of
+        size metre cells first. Points are ranked within their cell best first (highest
+        score, then lowest index) and kept in rank order, so every cell keeps its best
+        points and a cell only loses points while it holds more than the others; among
+        points of the same rank those in denser cells are dropped first.
+    '''
+    lon = numpy.asarray(lon, dtype=numpy.float64)
+    lat = numpy.asarray(lat, dtype=numpy.float64)
+    n = len(lon)
+    if n <= limit:
+        return numpy.ones(n, dtype=bool)
+
+    (cx, cy) = grid_cells(lon, lat, size)
+    cy -= cy.min()
+    key = cx * (int(cy.max()) + 1) + cy
+    score = numpy.zeros(n, dtype=numpy.int64) if score is None else numpy.asarray(score)
+    index = numpy.arange(n)
+
+    order = numpy.lexsort((index, -score, key))
+    (_, starts, inverse, counts) = numpy.unique(key[order], return_index=True, return_inverse=True, return_counts=True)
+    rank = numpy.empty(n, dtype=numpy.int64)
+    rank[order] = index - starts[inverse]
+    density = numpy.empty(n, dtype=numpy.int64)
+    density[order] = counts[inverse]
+
+    keep = numpy.zeros(n, dtype=bool)
+    keep[numpy.lexsort((index, -score, density, rank))[:limit]] = True
+    return keep
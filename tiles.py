@@ -0,0 +1,98 @@
+import collections
+import hashlib
+import json
+import math
+import os
+
+import numpy
+import shapely
+
+'''
+Bounding box tiling of the region to fetch.
+
+A plan starts from a grid of `size` degree tiles aligned to multiples of the size,
+keeping the tiles that intersect the region polygon. A tile whose query times out is
+split into its four quadrants right away, and a tile whose result is larger than the
+budget is split for the next run, as many levels as its size suggests. The refined
+tiles are kept in a JSON file, so later runs start from them and the number of
+requests follows the density of the data.
+
+Tiles do not overlap: an Overpass bbox includes its edges and returns a way or
+relation from every tile it touches, so each element is only kept by the tile that
+owns its position, tiles being half-open [south, north) x [west, east).
+'''
+
+
+# Tiles are not split below this height in degrees
+MIN_SIZE = 1 / 64
+
+
+class Tile(collections.namedtuple('Tile', 'south west north east')):
+    def bbox(self):
+        return f'{self.south},{self.west},{self.north},{self.east}'
+
+    def split(self):
+        lat = (self.south + self.north) / 2
+        lon = (self.west + self.east) / 2
+        return [Tile(self.south, self.west, lat, lon), Tile(self.south, lon, lat, self.east),
+                Tile(lat, self.west, self.north, lon), Tile(lat, lon, self.north, self.east)]
+
+    def owns(self, lon, lat):
+        return (lat >= self.south) & (lat < self.north) & (lon >= self.west) & (lon < self.east)
+
+
+def grid(polygon, size):
+    ''' The size degree tiles, aligned to multiples of size, that intersect polygon '''
+    (minx, miny, maxx, maxy) = polygon.bounds
+    tiles = [Tile(south, west, south + size, west + size)
+             for west in numpy.arange(math.floor(minx / size), math.floor(maxx / size) + 1) * size
+             for south in numpy.arange(math.floor(miny / size), math.floor(maxy / size) + 1) * size]
+    boxes = shapely.box(*numpy.array(tiles, dtype=numpy.float64).T[[1, 0, 3, 2]])
+    return [Tile(*map(float, tile)) for tile, inside in zip(tiles, shapely.intersects(polygon, boxes)) if inside]
+
+
+class Plan(object):
+    ''' The tiles of every query group (e.g. the union of all categories), starting from
+        grid(polygon, size) and refined by split(). Saved to path, if given.
+    '''
+
+    def __init__(self, polygon, size, path=None):
+        self.path = path
+        self.region = [size, hashlib.sha256(polygon.wkb).hexdigest()]
+        self.initial = grid(polygon, size)
+        self.groups = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved.get('region') == self.region:
+                self.groups = {group: [Tile(*tile) for tile in tiles] for group, tiles in saved['groups'].items()}
+
+    def tiles(self, group):
+        return list(self.groups.get(group, self.initial))
+
+    def split(self, group, tile, levels=1):
+        ''' Replace tile by its quadrants, levels deep. Returns the new tiles. '''
+        children = [tile]
+        for _ in range(levels):
+            children = [child for parent in children for child in parent.split()]
+        tiles = self.tiles(group)
+        if tile in tiles:
+            index = tiles.index(tile)
+            tiles[index:index + 1] = children
+            self.groups[group] = tiles
+        return children
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'region': self.region, 'groups': {group: [list(tile) for tile in tiles] for group, tiles in self.groups.items()}}, f)
+        os.replace(tmp, self.path)
+
+
+def levels(rows, budget):
+    ''' How many times a tile with rows elements has to be split to fit the budget '''
+    if not budget or rows <= budget:
+        return 0
+    return math.ceil(math.log(rows / budget, 4))
@@ -0,0 +1,201 @@
+import cProfile
+import glob
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+'''
+Timing and memory spans of a build, exported as one Chrome trace.
+
+Code marks the regions it wants measured:
+
+    with tracing.span('dedupe', category=name) as span:
+        ...
+        span.rows(len(poi))
+
+Once enable() is called every span records its wall time, CPU time (of its thread),
+the growth of the process' peak RSS and, with memory=True, the tracemalloc peak and
+net allocations while it was open. Spans nest per thread. Stage spans (stage=True)
+are additionally profiled with cProfile into <profile>/<name>.<string args>.<pid>.prof when
+a profile directory is given, unless a profiler already runs in that process.
+
+Events are appended to one file per process under <trace>.parts, which worker
+processes find through the OSM_POI_TRACE environment variable whatever their start
+method is, and finish() merges them into <trace> for chrome://tracing or Perfetto.
+
+While tracing is disabled span() returns a shared no-op context manager.
+'''
+
+ENVIRONMENT = 'OSM_POI_TRACE'
+
+_settings = None
+_local = threading.local()
+_lock = threading.Lock()
+# The span being profiled in each process, by pid, as forked workers inherit this
+_profiling = {}
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def rows(self, count):
+        pass
+
+    def set(self, **args):
+        pass
+
+
+_NULL = _NullSpan()
+
+
+def _stack():
+    # A forked worker inherits the stack of the thread that forked it
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.stack = []
+    return _local.stack
+
+
+def _peak_rss():
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def _emit(event):
+    path = os.path.join(_settings['parts'], f'{os.getpid()}.jsonl')
+    with _lock:
+        created = not os.path.exists(path)
+        with open(path, 'a') as f:
+            if created:
+                name = 'main' if os.getpid() == _settings['pid'] else 'worker'
+                f.write(json.dumps({'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'args': {'name': f'{name} {os.getpid()}'}}) + '\n')
+            f.write(json.dumps(event) + '\n')
+
+
+class Span(object):
+    def __init__(self, name, stage, args):
+        self.name = name
+        self.stage = stage
+        self.args = args
+        self.profile = None
+
+    def rows(self, count):
+        self.args['rows'] = self.args.get('rows', 0) + int(count)
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        stack = _stack()
+        if _settings['memory']:
+            (current, peak) = tracemalloc.get_traced_memory()
+            for span in stack:
+                span.malloc_peak = max(span.malloc_peak, peak)
+            tracemalloc.reset_peak()
+            self.malloc_start = self.malloc_peak = current
+        stack.append(self)
+
+        if self.stage and _settings['profile'] and os.getpid() not in _profiling:
+            self.profile = cProfile.Profile()
+            _profiling[os.getpid()] = self
+            self.profile.enable()
+
+        self.rss = _peak_rss()
+        self.cpu = time.thread_time_ns()
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        args = dict(self.args, cpu_ms=round((time.thread_time_ns() - self.cpu) / 1e6, 3),
+                    rss_peak_growth_mib=round((_peak_rss() - self.rss) / 2 ** 20, 1))
+        if self.profile is not None:
+            self.profile.disable()
+            del _profiling[os.getpid()]
+            label = re.sub(r'[^\w.-]+', '_', '.'.join([self.name] + [value for value in self.args.values() if isinstance(value, str)]))
+            self.profile.dump_stats(os.path.join(_settings['profile'], f'{label}.{os.getpid()}.prof'))
+
+        stack = _stack()
+        stack.remove(self)
+        if _settings['memory']:
+            (current, peak) = tracemalloc.get_traced_memory()
+            for span in stack + [self]:
+                span.malloc_peak = max(span.malloc_peak, peak)
+            tracemalloc.reset_peak()
+            args['malloc_peak_mib'] = round((self.malloc_peak - self.malloc_start) / 2 ** 20, 1)
+            args['malloc_net_mib'] = round((current - self.malloc_start) / 2 ** 20, 1)
+        if exc[0] is not None:
+            args['error'] = exc[0].__name__
+
+        _emit({'name': self.name, 'cat': 'stage' if self.stage else 'span', 'ph': 'X', 'pid': os.getpid(),
+               'tid': threading.get_native_id(), 'ts': self.start / 1000, 'dur': (end - self.start) / 1000, 'args': args})
+        return False
+
+
+def span(name, stage=False, **args):
+    ''' A context manager measuring the enclosed block, see the module documentation '''
+    if _settings is None:
+        return _NULL
+    return Span(name, stage, args)
+
+
+def enabled():
+    return _settings is not None
+
+
+def _configure(settings):
+    global _settings
+    _settings = settings
+    if settings['memory'] and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def enable(path, profile=None, memory=False):
+    ''' Start tracing this process and the worker processes it starts into the Chrome trace path '''
+    parts = os.path.abspath(path) + '.parts'
+    shutil.rmtree(parts, ignore_errors=True)
+    os.makedirs(parts)
+    if profile:
+        os.makedirs(profile, exist_ok=True)
+    settings = {'path': os.path.abspath(path), 'parts': parts, 'profile': profile and os.path.abspath(profile),
+                'memory': memory, 'pid': os.getpid()}
+    os.environ[ENVIRONMENT] = json.dumps(settings)
+    _configure(settings)
+
+
+def finish():
+    ''' Stop tracing and merge the events of all processes into the trace file '''
+    global _settings
+    if _settings is None:
+        return None
+    settings = _settings
+    _settings = None
+    os.environ.pop(ENVIRONMENT, None)
+
+    events = []
+    for part in sorted(glob.glob(os.path.join(settings['parts'], '*.jsonl'))):
+        with open(part) as f:
+            events += [json.loads(line) for line in f if line.strip()]
+    with open(settings['path'], 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    shutil.rmtree(settings['parts'], ignore_errors=True)
+    return settings['path']
+
+
+if ENVIRONMENT in os.environ and _settings is None:
+    _configure(json.loads(os.environ[ENVIRONMENT]))
@@ -71,20 +71,33 @@ def indent(elem, level=0):
         if level and (not elem.tail or not elem.tail.strip()):
             elem.tail = i
 
+import itertools
+import shutil
+
+import numpy
 import pandas
 
-def read_geo(source):
+# Rows per batch when a writer reads its source in chunks
+BATCH_SIZE = 100000
+
+def read_geo(source,chunksize=None):
+  ''' Read a CSV, GPX or POI bundle source into a DataFrame with lon, lat, name and
+      optionally comment columns. With a chunksize an iterator of DataFrames of at most
+      chunksize rows is returned instead, so the whole source is never in memory at once.
+  '''
   (_,extension) = os.path.splitext(source)
   extension = extension.lower()
 
   if extension == '.csv':
-    return read_geo_csv(source)
+    return read_geo_csv(source,chunksize)
   elif extension == '.gpx':
-    return read_geo_gpx(source)
+    return read_geo_gpx(source,chunksize)
+  elif extension == '.poi':
+    return read_geo_poi(source,chunksize)
   else:
     raise Exception("Unknown extension %s" % extension)
 
-def read_geo_csv(source):
+def read_geo_csv(source,chunksize=None):
   ''' Try and handle CSVs with or without headers
 
       * Expects ',' separators
@@ -94,6 +107,7 @@ def read_geo_csv(source):
       * Expects '\\' for escape
       * If no header is present it assumes 3+ columns with longitude, latitude and name
       * If a header is present it attempts to find the longitude, latitude and name columns
+      * With a chunksize an iterator of DataFrames is returned
 
   '''
   print("Parsing CSV %s" % (source))
@@ -114,10 +128,10 @@ def read_geo_csv(source):
     # does not have a header, we assume the fields are long,lat,name
     if len(df.columns)!=3:
       raise Exception("Expected 3 columns in headerless csv file %s, got %d" % (source,len(df.columns)))
-    return pandas.read_csv(source,header=None,names=[ 'lon', 'lat', 'name' ],**csv_opts)
+    return pandas.read_csv(source,header=None,names=[ 'lon', 'lat', 'name' ],chunksize=chunksize,**csv_opts)
   else:
     # has a header
-    df = pandas.read_csv(source,**csv_opts)
+    df = pandas.read_csv(source,nrows=0,**csv_opts)
     print ("Found Columns: %s" % df.columns)
 
     # Use lowercase for column names and remove whitespace
@@ -153,18 +167,20 @@ def read_geo_csv(source):
     if not have_longitude or not have_latitude or not have_name:
       raise Exception("Failed to find longitude, latitude and name columns")
 
-    return df
+    # Read the rows under the column names worked out from the header
+    return pandas.read_csv(source,header=0,names=list(df.columns),chunksize=chunksize,**csv_opts)
 
 try:
     import xml.etree.cElementTree as ET
 except ImportError:
     import xml.etree.ElementTree as ET
 
-def read_geo_gpx(source):
+def read_geo_gpx(source,chunksize=None):
   '''
   Try and read a GPX file.
 
-  We only read in waypoints (wpt)
+  We only read in waypoints (wpt), streaming, so with a chunksize an iterator of
+  DataFrames is returned without holding the whole document
 
   From gpx schema v1.1:
     wpt (wptType)
@@ -194,32 +210,97 @@ def read_geo_gpx(source):
         extensions (extensionsType)
   '''
 
-  # Read in the XML and strip all namespaces
-  it = ET.iterparse(source)
-  for _, el in it:
-      if '}' in el.tag:
-          el.tag = el.tag.split('}', 1)[1]  # strip all namespaces
-  root = it.root
+  waypoints = gpx_waypoints(source)
+  if chunksize is None:
+    return waypoint_frame(list(waypoints))
+  return (waypoint_frame(batch) for batch in batches(waypoints,chunksize))
 
-  if root.tag != 'gpx':
-    raise Exception('Failed to find gpx tag in xml file %s' % (source))
-
-  waypoints=[]
-
-  for c in root:
-    if c.tag=='wpt':
+def gpx_waypoints(source):
+  ''' Yield a dict of the attributes and child elements of every waypoint in source '''
+  depth = 0
+  root = None
+  # Read in the XML and strip all namespaces
+  for event, el in ET.iterparse(source,events=('start','end')):
+    if '}' in el.tag:
+      el.tag = el.tag.split('}', 1)[1]  # strip all namespaces
+    if event == 'start':
+      if root is None:
+        root = el
+        if root.tag != 'gpx':
+          raise Exception('Failed to find gpx tag in xml file %s' % (source))
+      depth += 1
+      continue
+    depth -= 1
+    if depth != 1:
+      continue
+
+    if el.tag=='wpt':
       wpt={}
-      for a in c.attrib:
-        wpt[a] = c.attrib[a]
-      for e in c:
+      for a in el.attrib:
+        wpt[a] = el.attrib[a]
+      for e in el:
         wpt[e.tag] = e.text
       wpt.pop('desc', None)
       wpt.pop('link', None)
-      if 'node' in wpt.get('name', ''):
-        continue
-      waypoints.append(wpt)
+      if 'node' not in wpt.get('name', ''):
+        yield wpt
+    # Done with this element, drop it from the tree
+    root.remove(el)
 
+def waypoint_frame(waypoints):
   df = pandas.DataFrame(waypoints)
   df[['lat','lon']] = df[['lat','lon']].apply(pandas.to_numeric)
-
   return df
+
+def batches(iterable,size):
+  ''' Lists of up to size consecutive items of iterable '''
+  iterator = iter(iterable)
+  while batch := list(itertools.islice(iterator,size)):
+    yield batch
+
+def write_geo_poi(dest,lon,lat,name,comment=None):
+  ''' Write a POI bundle: a directory holding .npy arrays
+
+      * lon.npy, lat.npy - float64 coordinates
+      * name.npy - int32 index into names.npy for every POI
+      * names.npy - the distinct names
+      * comment.npy, comments.npy - optional comments, encoded like the names
+  '''
+  tmp = dest + '.tmp'
+  shutil.rmtree(tmp,ignore_errors=True)
+  os.makedirs(tmp)
+  numpy.save(os.path.join(tmp,'lon.npy'),numpy.asarray(lon,dtype=numpy.float64))
+  numpy.save(os.path.join(tmp,'lat.npy'),numpy.asarray(lat,dtype=numpy.float64))
+
+  for (column,values) in (('name',name),('comment',comment)):
+    if values is not None:
+      (codes,uniques) = pandas.factorize(numpy.asarray(values,dtype=object))
+      numpy.save(os.path.join(tmp,column+'.npy'),codes.astype(numpy.int32))
+      numpy.save(os.path.join(tmp,column+'s.npy'),numpy.asarray(uniques,dtype=str))
+
+  shutil.rmtree(dest,ignore_errors=True)
+  os.rename(tmp,dest)
+
+def read_geo_poi(source,chunksize=None):
+  ''' Read a POI bundle written by write_geo_poi. The coordinate and name index
+      arrays are memory-mapped, names are returned as a pandas Categorical. With a
+      chunksize an iterator of DataFrames over consecutive slices is returned.
+  '''
+  arrays = { 'lon': numpy.load(os.path.join(source,'lon.npy'),mmap_mode='r'),
+             'lat': numpy.load(os.path.join(source,'lat.npy'),mmap_mode='r') }
+  dtypes = {}
+
+  for column in ('name','comment'):
+    if os.path.exists(os.path.join(source,column+'.npy')):
+      arrays[column] = numpy.load(os.path.join(source,column+'.npy'),mmap_mode='r')
+      dtypes[column] = pandas.CategoricalDtype(numpy.load(os.path.join(source,column+'s.npy')))
+
+  def frame(start,stop):
+    columns = { column: pandas.Categorical.from_codes(values[start:stop],dtype=dtypes[column]) if column in dtypes else values[start:stop]
+                for (column,values) in arrays.items() }
+    return pandas.DataFrame(columns,copy=False)
+
+  rows = len(arrays['lon'])
+  if chunksize is None:
+    return frame(0,rows)
+  return (frame(start,start+chunksize) for start in range(0,rows,chunksize))